@@ -8,10 +8,28 @@ program available from NCBI.
 import biotools.IO as io
 import subprocess
 from os import sep, getenv, listdir
+from os.path import getsize, getmtime, abspath, exists
+from xml.etree import cElementTree as ElementTree
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import threading
+import tempfile
+import hashlib
+import sqlite3
 import shutil
 
+# the columns asked for in tabular output, and the BLAST+ argument for them.
+COLUMNS = ['qseqid', 'stitle', 'qlen', 'slen', 'qstart', 'qend', 'sstart',
+           'send', 'evalue', 'bitscore', 'score', 'length', 'nident',
+           'positive', 'gaps', 'qframe', 'sframe', 'qseq', 'sseq']
+OUTFMTS = {'text': 0, 'xml': 5, 'tabular': 6, 'commented': 7}
 
-def run(db, sfile, mega_blast=False, **kwargs):
+
+def run(db, sfile, mega_blast=False, outfmt=0, max_evalue=None,
+        min_identity=None, shards=1, ordered=False, registry=None,
+        **kwargs):
     '''
     Takes a database and a query and runs the appropriate type of BLAST on
     them. The database can be an existing BLAST database or a fasta/fastq
@@ -23,8 +41,34 @@ def run(db, sfile, mega_blast=False, **kwargs):
     Optional named arguments can currently only be `evalue`, `num_threads`,
     `gapopen`, or `gapextend`. The correspond to the BLAST options of the same
     name.
+
+    BLAST's report is read in the format given by `outfmt`: 0 (or 'text')
+    for the usual pairwise report, 6 or 7 ('tabular' or 'commented') for
+    tabular output with the columns in `COLUMNS`, or 5 ('xml') for BLAST
+    XML. The tabular and XML reports are much smaller and quicker to read,
+    and give the same results, except that tabular reports leave out the
+    `defline` of the query. `outfmt` can't be used with `mega_blast`.
+
+    Hits with an e-value over `max_evalue` or a fraction of identities
+    under `min_identity` are skipped (see `Result`).
+
+    If `shards` is more than 1, the query file is split into that many
+    pieces (without splitting any sequences), and a BLAST process is run on
+    each of them at the same time; `num_threads` is then shared between
+    them. Their hits are read as one `ShardedResult`, in the order of the
+    query file if `ordered` is set.
+
+    If a `DatabaseRegistry` is given as `registry`, it is looked in first
+    for a database made from `db`, and databases that are found or made
+    from sequence files are put in it.
     '''
 
+    outfmt = OUTFMTS.get(outfmt, outfmt)
+    if outfmt not in (0, 5, 6, 7):
+        raise ValueError("Unknown BLAST output format: %s" % outfmt)
+    if outfmt and mega_blast:
+        raise ValueError("megablast can only give the pairwise report.")
+
     cmds = {
         'prot': {
             'prot': 'blastp',
@@ -39,6 +83,58 @@ def run(db, sfile, mega_blast=False, **kwargs):
     seq = io.open(sfile, 'r').next()
     qtype = seq.type
 
+    dbtype, entry = None, None
+    if registry is not None:
+        entry = registry.get(db)
+        if entry is not None and entry[2]:
+            db, dbtype = entry[:2]
+    if dbtype is None:
+        db, dbtype = _database(db, registry, entry is not None)
+    if shards > 1 and 'num_threads' in kwargs:
+        kwargs['num_threads'] = max(1, int(kwargs['num_threads']) // shards)
+    allowed = set(["evalue", "gapopen", "gapextend", "num_threads"]) & \
+        set(kwargs.keys())
+    cmd = cmds[qtype][dbtype]
+    pn = ["-db", "-query"]
+    if mega_blast:
+        cmd = "megablast"
+        pn = ["-d", "-i"]
+        allowed = ["e", "a"]
+    args = [arg for pair in [["-" + k, str(kwargs[k])] for k in allowed]
+            for arg in pair]
+    if outfmt in (6, 7):
+        args += ["-outfmt", "%d %s" % (outfmt, ' '.join(COLUMNS))]
+    elif outfmt == 5:
+        args += ["-outfmt", "5"]
+
+    def blast(query):
+        proc = subprocess.Popen([cmd, pn[0], db, pn[1], query] + args,
+                                bufsize=1, stdout=subprocess.PIPE)
+        if outfmt == 5:
+            return Result(proc.stdout, outfmt, cmd, max_evalue, min_identity)
+        return Result(iter(proc.stdout.readline, ''), outfmt, cmd,
+                      max_evalue, min_identity)
+
+    if shards <= 1:
+        return blast(sfile)
+    tmpdir = tempfile.mkdtemp(prefix='blast')
+    try:
+        results = [blast(query) for query in _shard(sfile, shards, tmpdir)]
+    except:
+        shutil.rmtree(tmpdir, True)
+        raise
+    return ShardedResult(results, ordered, tmpdir)
+
+
+def _database(db, registry=None, stale=False):
+    '''
+    Finds the BLAST database `db`, or the one made from the sequence file
+    `db` (making it if there isn't one), and gives its name and type. A
+    database made from a sequence file is put in the `registry`, if there
+    is one. If `stale` is set, the database made from the sequence file is
+    out of date, and is made again.
+    '''
+
     rcloc = ''
     for loc in (".:~:" + (getenv("NCBI") or "")).split(':'):
         if loc and loc[-1] == sep:
@@ -86,7 +182,7 @@ def run(db, sfile, mega_blast=False, **kwargs):
         else:
             dbdir, db = '.', db[:pos]
 
-        for file in listdir(dbdir):
+        for file in ([] if stale else listdir(dbdir)):
             dpos = file.rfind('.')
             if dpos >= 0 and file[dpos + 1:] == dbtype[0] + 'in':
                 fh = open(dbdir + sep + file, 'r')
@@ -94,7 +190,8 @@ def run(db, sfile, mega_blast=False, **kwargs):
                 fname = fh.read(c)
                 if fname[0] in ("'", '"'):
                     fname = fname[1:-1]
-                if fname.endswith(odb):
+                if fname.endswith(odb) and (registry is None or
+                        getmtime(dbdir + sep + file) >= getmtime(odb)):
                     ndb = dbdir + sep + file[:dpos]
                     break
         if not ndb:
@@ -119,27 +216,342 @@ def run(db, sfile, mega_blast=False, **kwargs):
             db = dbdir + sep + ndb
         else:
             db = ndb
+        if registry is not None:
+            registry.put(odb, db, dbtype)
     else:
         raise IOError("Database not found: " + db)
-    allowed = set(["evalue", "gapopen", "gapextend", "num_threads"]) & \
-        set(kwargs.keys())
-    cmd = cmds[qtype][dbtype]
-    pn = ["-db", "-query"]
-    if mega_blast:
-        cmd = "megablast"
-        pn = ["-d", "-i"]
-        allowed = ["e", "a"]
-    args = [cmd, pn[0], db, pn[1], sfile] + [arg for pair in
-            [["-" + k, str(kwargs[k])] for k in allowed] for arg in pair]
-    proc = subprocess.Popen(args, bufsize=1, stdout=subprocess.PIPE)
-    return Result(iter(proc.stdout.readline, ''))
+    return db, dbtype
+
+
+def _shard(sfile, shards, dirname):
+    '''
+    Splits the FASTA file `sfile` into at most `shards` files in `dirname`,
+    of about the same size and without splitting any records, and gives
+    their names, in order.
+    '''
+
+    size = getsize(sfile)
+    names, out, done = [], None, 0
+    with open(sfile, 'r') as fh:
+        for line in fh:
+            if line[:1] == '>' and done * shards >= size * len(names):
+                if out is not None:
+                    out.close()
+                names.append(dirname + sep + 'query%d.fasta' % len(names))
+                out = open(names[-1], 'w')
+            if out is not None:
+                out.write(line)
+            done += len(line)
+    if out is not None:
+        out.close()
+    return names
+
+
+def _checksum(filename):
+    '''
+    The SHA-1 digest of the contents of a file.
+    '''
+
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DatabaseRegistry(object):
+    '''
+    Remembers which BLAST databases were made from which sequence files, in
+    the SQLite database `filename` (which is made if it doesn't exist), so
+    that `run` doesn't have to search for them every time. Along with the
+    name and type of each database, the modification time, size and
+    checksum of its sequence file are kept, so that a database whose
+    sequence file has changed since can be made again.
+
+    SQLite does its own locking, so any number of threads and processes can
+    share one registry.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._execute('CREATE TABLE IF NOT EXISTS databases ' +
+                      '(source TEXT PRIMARY KEY, mtime REAL, size INTEGER, ' +
+                      'checksum TEXT, db TEXT, dbtype TEXT)')
+
+    def _execute(self, query, args=()):
+        '''
+        Runs `query` in a connection of its own (so that registries can be
+        used from any thread, and across forks) and gives the rows.
+        '''
+
+        db = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with db:
+                return db.execute(query, args).fetchall()
+        finally:
+            db.close()
+
+    def get(self, source):
+        '''
+        The name and type of the database made from the sequence file
+        `source`, and whether it is up to date, or `None` if there is no
+        such database. The checksum of `source` is only worked out if its
+        modification time has changed but its size hasn't.
+        '''
+
+        source = abspath(source)
+        rows = self._execute('SELECT mtime, size, checksum, db, dbtype ' +
+                             'FROM databases WHERE source = ?', (source,))
+        if not rows:
+            return None
+        mtime, size, checksum, db, dbtype = rows[0]
+        if not exists(db + '.' + dbtype[0] + 'in'):
+            self._execute('DELETE FROM databases WHERE source = ?', (source,))
+            return None
+        try:
+            current = (getmtime(source), getsize(source))
+        except OSError:
+            return None
+        if current == (mtime, size):
+            return db, dbtype, True
+        if current[1] != size or _checksum(source) != checksum:
+            return db, dbtype, False
+        self._execute('UPDATE databases SET mtime = ? WHERE source = ?',
+                      (current[0], source))
+        return db, dbtype, True
+
+    def put(self, source, db, dbtype):
+        '''
+        Records that the database `db`, of type `dbtype` (`'prot'` or
+        `'nucl'`), was made from the sequence file `source` as it is now.
+        '''
+
+        self._execute('INSERT OR REPLACE INTO databases VALUES ' +
+                      '(?, ?, ?, ?, ?, ?)',
+                      (abspath(source), getmtime(source), getsize(source),
+                       _checksum(source), abspath(db), dbtype))
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM databases')[0][0]
+
+
+def _fraction(count, length):
+    '''
+    A count out of an alignment length, as BLAST's pairwise report gives it,
+    e.g., `45/50 (90%)`.
+    '''
+
+    percent = int(round(100.0 * count / length)) if length else 0
+    return '%d/%d (%d%%)' % (count, length, percent)
+
+
+def _frames(program, qframe, sframe):
+    '''
+    The `frame` and `strand` (for blastn) of a hit, as the pairwise report
+    would give them, from the frames of the query and subject.
+    '''
+
+    if program == 'blastn' or (program is None and abs(qframe) == 1 and
+                               abs(sframe) == 1):
+        strands = {1: 'Plus', -1: 'Minus'}
+        return None, '%s/%s' % (strands[qframe], strands[sframe])
+    if program == 'blastx' or (program is None and not sframe and qframe):
+        return '%+d' % qframe, None
+    if program == 'tblastn' or (program is None and not qframe and sframe):
+        return '%+d' % sframe, None
+    if program == 'tblastx' or (program is None and qframe and sframe):
+        return '%+d/%+d' % (qframe, sframe), None
+    return None, None
+
+
+def _identity(count, length):
+    '''
+    The fraction of identities in an alignment, to the percent, as BLAST
+    reports it.
+    '''
+
+    return int(round(100.0 * count / length)) / 100.0 if length else 0.0
+
+
+class HitSequence(object):
+    '''
+    One side (the query or the subject) of a BLAST hit: the `name` and
+    `defline` of the sequence, and the `start` and `end` of the alignment
+    on it. The aligned `sequence` (with gaps) is only put together when it
+    is asked for. For compatibility, the fields can also be looked up like
+    those of a dictionary (e.g., `seq['start']`).
+    '''
+    __slots__ = ('name', 'defline', 'start', 'end', '_rows')
+    _keys = ('name', 'defline', 'start', 'end', 'sequence', 'length')
+
+    def __init__(self, name, defline, start, end, rows):
+        '''
+        `rows` is either the aligned sequence, a list of its pieces, or a
+        pair of a tab-separated string and the index of the sequence in it.
+        '''
+
+        self.name = name
+        self.defline = defline
+        self.start = start
+        self.end = end
+        self._rows = rows
+
+    @property
+    def sequence(self):
+        rows = self._rows
+        if type(rows) is tuple:
+            rows = rows[0].split('\t')[rows[1]].rstrip('\r\n')
+        elif type(rows) is list:
+            rows = ''.join(rows)
+        self._rows = rows
+        return rows
+
+    @property
+    def length(self):
+        return abs(self.end - self.start + 1)
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def todict(self):
+        '''
+        The fields of this sequence, as a dictionary.
+        '''
+
+        return dict((key, getattr(self, key)) for key in self._keys)
+
+
+class Hit(object):
+    '''
+    A BLAST hit (an HSP): the `query` and `subject` `HitSequence`s, the
+    `length` of the query, the `evalue`, the score in `bits` and its raw
+    `score`, the number of `identities`, `positives`, and `gaps` in the
+    alignment, which is `align_length` long, and the `frame` (or `strand`,
+    for blastn) of the hit, as the pairwise report gives them.
+
+    For compatibility, hits can also be looked up like the dictionaries
+    that `Result` used to give, with the same keys and values (e.g.,
+    `hit['identities']` is a string such as `'45/50 (90%)'`).
+    '''
+    __slots__ = ('query', 'subject', 'length', 'evalue', 'bits', 'score',
+                 'identities', 'positives', 'gaps', 'align_length', 'frame',
+                 'strand')
+
+    def __init__(self, query, subject, length, evalue, bits, score,
+                 identities, positives, gaps, align_length, frame=None,
+                 strand=None):
+        self.query = query
+        self.subject = subject
+        self.length = length
+        self.evalue = evalue
+        self.bits = bits
+        self.score = score
+        self.identities = identities
+        self.positives = positives
+        self.gaps = gaps
+        self.align_length = align_length
+        self.frame = frame
+        self.strand = strand
+
+    @property
+    def identity(self):
+        '''
+        The fraction of identities, to the percent, as BLAST reports it.
+        '''
+
+        return _identity(self.identities, self.align_length)
+
+    def __getitem__(self, key):
+        if key in ('query', 'subject', 'length'):
+            return getattr(self, key)
+        if key == 'expect':
+            return '%g' % self.evalue
+        if key == 'score':
+            return '%g bits (%d)' % (self.bits, self.score)
+        if key in ('identities', 'positives', 'gaps') and \
+                getattr(self, key) is not None:
+            return _fraction(getattr(self, key), self.align_length)
+        if key in ('frame', 'strand') and getattr(self, key) is not None:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def todict(self):
+        '''
+        This hit as the nested dictionaries that `Result` used to give.
+        '''
+
+        res = {'query': self.query.todict(),
+               'subject': self.subject.todict()}
+        for key in ('length', 'expect', 'score', 'identities', 'positives',
+                    'gaps', 'frame', 'strand'):
+            if self.get(key) is not None:
+                res[key] = self[key]
+        return res
+
+
+def _hit(qname, qdefline, qlen, sname, sdefline, qstart, qend, sstart,
+         send, evalue, bits, score, identities, positives, gaps, length,
+         qframe, sframe, qseq, sseq, program, result):
+    '''
+    Makes a `Hit` out of the (string) values of an HSP from a tabular or XML
+    report, or None if it doesn't pass the filters of `result`. If no
+    `sdefline` is given, `sname` is taken to be the whole title of the
+    subject.
+    '''
+
+    evalue, identities, length = float(evalue), int(identities), int(length)
+    if not result._accept(evalue, identities, length):
+        return None
+    if not sdefline:
+        title = sname.split(None, 1)
+        sname, sdefline = title[0], (title[1:] or [''])[0]
+    frame, strand = _frames(program, int(qframe or 0), int(sframe or 0))
+    return Hit(HitSequence(qname, qdefline, int(qstart), int(qend), qseq),
+               HitSequence(sname, sdefline, int(sstart), int(send), sseq),
+               int(qlen), evalue, float(bits), int(float(score)), identities,
+               int(positives), int(gaps), length, frame, strand)
+
+
+class _Lines(object):
+    '''
+    A file-like object that reads from an iterable of lines.
+    '''
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+
+    def read(self, size=-1):
+        return next(self.lines, '')
+
+
+def _names(id, definition, generated):
+    '''
+    The name and definition line of a query or hit in an XML report. BLAST
+    makes up IDs (like `Query_1` or `gnl|BL_ORD_ID|0`) for sequences that
+    don't have one it can parse, and puts the whole definition line in the
+    definition; the name is then its first word, as in the pairwise report.
+    '''
+
+    if id.startswith(generated):
+        words = definition.split(None, 1)
+        return {'name': words[0] if words else id,
+                'defline': words[1] if len(words) > 1 else ''}
+    return {'name': id, 'defline': definition}
 
 
 class Result(object):
 
     '''
-    A class which take the raw output from BLAST and generates dictionaries
-    from the data from BLAST. This data includes the alignment, percent
+    A class which takes the raw output from BLAST and generates `Hit`s from
+    the data from BLAST. This data includes the alignment, percent
     identity, gaps, e-value, score, length of subject, length of query, and
     start and stop positions for both sequences. This class should be used in
     a for loop like so:
@@ -151,20 +563,161 @@ class Result(object):
 
     The class instance has a single other property, `headers`, which are the
     lines in BLAST results before the BLAST hits (e.g., citation info, etc.).
+
+    Tabular (`outfmt` 6 or 7, with the columns in `COLUMNS`) and XML
+    (`outfmt` 5) reports can be read too, and give results of the same
+    shape. `program` (e.g., `'blastx'`) says which of the frames of the
+    query and subject the `frame` of a result is; it is guessed from the
+    frames if it isn't given (and, in commented tabular reports, read from
+    the comments).
+
+    Hits with an e-value over `max_evalue`, or with a fraction of
+    identities (to the percent, as BLAST reports it) under `min_identity`,
+    are skipped as soon as those are read, without the rest of the hit
+    being put together.
     '''
 
-    def __init__(self, file):
+    def __init__(self, file, outfmt=0, program=None, max_evalue=None,
+                 min_identity=None):
         self.file = file
+        self.outfmt = OUTFMTS.get(outfmt, outfmt)
+        self.program = program
+        self.max_evalue = max_evalue
+        self.min_identity = min_identity
         self.headers = []
 
-    def __iter__(self):
+    def _accept(self, evalue, identities, length):
+        '''
+        Whether a hit passes the `max_evalue` and `min_identity` filters.
+        '''
+
+        if self.max_evalue is not None and evalue > self.max_evalue:
+            return False
+        if self.min_identity is not None and \
+                _identity(identities, length) < self.min_identity:
+            return False
+        return True
+
+    def _input(self):
+        '''
+        The lines of the report, whether it is a file name, a string, or
+        an iterable of lines.
+        '''
+
         try:
-            ipt = open(self.file, 'r')
+            return open(self.file, 'r')
         except (IOError, TypeError):
             try:
-                ipt = self.file.split('\n')
+                return self.file.split('\n')
             except:
-                ipt = self.file
+                return self.file
+
+    def __iter__(self):
+        if self.outfmt in (6, 7):
+            return self._tabular()
+        if self.outfmt == 5:
+            return self._xml()
+        return self._text()
+
+    def _tabular(self):
+        '''
+        Reads a tabular report.
+        '''
+
+        # the aligned sequences are the last two columns, and are only split
+        # apart when they are asked for.
+        (qseqid, stitle, qlen, slen, qstart, qend, sstart, send, evalue,
+         bitscore, score, length, nident, positive, gaps, qframe, sframe,
+         seqs) = range(len(COLUMNS) - 1)
+        program = self.program
+        for line in self._input():
+            if not line.strip():
+                continue
+            if line[0] == '#':
+                self.headers.append(line.rstrip('\r\n'))
+                words = line[1:].split()
+                if program is None and words and words[0] in \
+                        ('BLASTN', 'BLASTP', 'BLASTX', 'TBLASTN', 'TBLASTX'):
+                    program = words[0].lower()
+                continue
+            hsp = line.split('\t', seqs)
+            hit = _hit(hsp[qseqid], '', hsp[qlen], hsp[stitle], '',
+                       hsp[qstart], hsp[qend], hsp[sstart], hsp[send],
+                       hsp[evalue], hsp[bitscore], hsp[score], hsp[nident],
+                       hsp[positive], hsp[gaps], hsp[length], hsp[qframe],
+                       hsp[sframe], (hsp[seqs], 0), (hsp[seqs], 1), program,
+                       self)
+            if hit is not None:
+                yield hit
+        raise StopIteration()
+
+    def _xml(self):
+        '''
+        Reads a BLAST XML report, one HSP at a time.
+        '''
+
+        handle = self.file
+        if not hasattr(handle, 'read'):
+            try:
+                handle = open(handle, 'r')
+            except (IOError, TypeError):
+                try:
+                    handle = _Lines(handle.splitlines(True))
+                except AttributeError:
+                    handle = _Lines(handle)
+
+        tags = {'Hsp_bit-score': 'bitscore', 'Hsp_score': 'score',
+                'Hsp_evalue': 'evalue', 'Hsp_query-from': 'qstart',
+                'Hsp_query-to': 'qend', 'Hsp_hit-from': 'sstart',
+                'Hsp_hit-to': 'send', 'Hsp_query-frame': 'qframe',
+                'Hsp_hit-frame': 'sframe', 'Hsp_identity': 'nident',
+                'Hsp_positive': 'positive', 'Hsp_gaps': 'gaps',
+                'Hsp_align-len': 'length', 'Hsp_qseq': 'qseq',
+                'Hsp_hseq': 'sseq'}
+        program = self.program
+        query, hit, hsp = {}, {}, {}
+        for event, elem in ElementTree.iterparse(handle):
+            tag = elem.tag
+            if tag in tags:
+                hsp[tags[tag]] = elem.text or ''
+            elif tag == 'Hsp':
+                get = hsp.get
+                found = _hit(query['name'], query['defline'],
+                             query['length'], hit['name'], hit['defline'],
+                             get('qstart'), get('qend'), get('sstart'),
+                             get('send'), get('evalue'), get('bitscore'),
+                             get('score'), get('nident'),
+                             get('positive', get('nident')),
+                             get('gaps', '0'), get('length'), get('qframe'),
+                             get('sframe'), get('qseq', ''), get('sseq', ''),
+                             program, self)
+                if found is not None:
+                    yield found
+                hsp = {}
+                elem.clear()
+            elif tag in ('Iteration_query-ID', 'Iteration_query-def',
+                         'Iteration_query-len', 'Hit_id', 'Hit_def'):
+                (query if tag[0] == 'I' else hit)[tag] = elem.text or ''
+                if tag == 'Iteration_query-len':
+                    query.update(_names(query['Iteration_query-ID'],
+                                        query['Iteration_query-def'],
+                                        'Query_'))
+                    query['length'] = elem.text
+                elif tag == 'Hit_def':
+                    hit.update(_names(hit['Hit_id'], hit['Hit_def'],
+                                      'gnl|BL_ORD_ID|'))
+            elif tag == 'BlastOutput_program' and program is None:
+                program = elem.text
+            if tag in ('Hit', 'Iteration', 'BlastOutput_param'):
+                elem.clear()
+        raise StopIteration()
+
+    def _text(self):
+        '''
+        Reads a pairwise report.
+        '''
+
+        ipt = self._input()
         mode = 0
         headers = []
         curr = None
@@ -181,24 +734,49 @@ class Result(object):
                     'defline': '',
                     'start': None,
                     'end':   None,
-                    'sequence': ''
+                    'sequence': []
                 },
                 'query': {
                     'name':  qn,
                     'defline': qdl,
                     'start': None,
                     'end':   None,
-                    'sequence': ''
+                    'sequence': []
                 },
                 'length':  l
             }
 
+        def counts(sh, key):
+            # e.g., "45/50 (90%)"
+            if key not in sh:
+                return None, None
+            count, length = sh[key].split()[0].split('/')
+            return int(count), int(length)
+
+        def keep(sh):
+            if 'keep' not in sh:
+                evalue = sh['expect']
+                sh['evalue'] = float('1' + evalue if evalue[0] == 'e'
+                                     else evalue)
+                sh['identities'], sh['align_length'] = \
+                    counts(sh, 'identities')
+                sh['keep'] = self._accept(sh['evalue'], sh['identities'],
+                                          sh['align_length'])
+            return sh['keep']
+
         def ra(sh):
-            for res in ('subject', 'query'):
-                sh[res]['start'] = int(sh[res]['start'])
-                sh[res]['end'] = int(sh[res]['end'])
-                sh[res]['length'] = abs(sh[res]['end'] - sh[res]['start'] + 1)
-            return sh
+            if not keep(sh):
+                return []
+            seqs = [HitSequence(sh[res]['name'], sh[res]['defline'],
+                                int(sh[res]['start']), int(sh[res]['end']),
+                                sh[res]['sequence'])
+                    for res in ('query', 'subject')]
+            score = sh['score'].split()
+            return [Hit(seqs[0], seqs[1], sh['length'], sh['evalue'],
+                        float(score[0]), int(score[2].strip('()')),
+                        sh['identities'], counts(sh, 'positives')[0],
+                        counts(sh, 'gaps')[0] or 0, sh['align_length'],
+                        sh.get('frame'), sh.get('strand'))]
 
         def sh_fmt(l):
             for pairs in (a.strip() for a in l.split(',')):
@@ -211,6 +789,7 @@ class Result(object):
             if not line:
                 if mode == 4:
                     mode = 5
+                    keep(subheaders)
                 continue
 
             if mode == 0:
@@ -269,20 +848,25 @@ class Result(object):
                 if line[:6] == 'Query=':
                     mode = 1
                     qname = line[6:].lstrip()
-                    yield ra(subheaders)
+                    for hit in ra(subheaders):
+                        yield hit
                     continue
                 elif line[0] == '>':
-                    yield ra(subheaders)
+                    for hit in ra(subheaders):
+                        yield hit
                     subheaders = sh(line[1:], qname, length)
                     mode = 3
                     continue
                 elif line[:5] == 'Score':
-                    yield ra(subheaders)
+                    for hit in ra(subheaders):
+                        yield hit
                     subheaders = sh(subheaders['subject']['name'], qname,
                                     length)
                     sh_fmt(line)
                     mode = 4
                     continue
+                elif not keep(subheaders):
+                    continue
                 elif line[:5] == 'Sbjct':
                     curr = 'subject'
                 elif line[:5] == 'Query':
@@ -293,18 +877,161 @@ class Result(object):
                 _, start, seq, end = line.split()
                 subheaders[curr]['start'] = subheaders[curr]['start'] or start
                 subheaders[curr]['end'] = end
-                subheaders[curr]['sequence'] += seq
+                subheaders[curr]['sequence'].append(seq)
 
         try:
-            yield ra(subheaders)
+            for hit in ra(subheaders):
+                yield hit
         except UnboundLocalError:
             pass
         raise StopIteration()
 
+
+class ShardedResult(object):
+    '''
+    The hits of several `Result`s (e.g., those of BLAST runs on pieces of a
+    query file) as one stream. Each result is read in its own thread, and
+    hits are given as soon as they are read, or, if `ordered` is set, in
+    the order of the results: the hits of each result are held until those
+    before it are done. `headers` are those of the first result. If
+    `tmpdir` is given, it is removed once all of the hits have been read.
+    '''
+
+    def __init__(self, results, ordered=False, tmpdir=None):
+        self.results = results
+        self.ordered = ordered
+        self.tmpdir = tmpdir
+
+    @property
+    def headers(self):
+        return self.results[0].headers if self.results else []
+
+    def _read(self, i, hits):
+        '''
+        Puts the hits of the `i`th result in the queue `hits`, then `None`
+        (or the exception that stopped it).
+        '''
+
+        try:
+            for hit in self.results[i]:
+                hits.put((i, hit, None))
+            hits.put((i, None, None))
+        except Exception as e:
+            hits.put((i, None, e))
+
+    def __iter__(self):
+        n = len(self.results)
+        hits = queue.Queue(1024)
+        for i in range(n):
+            thread = threading.Thread(target=self._read, args=(i, hits))
+            thread.daemon = True
+            thread.start()
+
+        waiting = [[] for i in range(n)]
+        done = [False] * n
+        current, left = 0, n
+        try:
+            while left:
+                i, hit, error = hits.get()
+                if error is not None:
+                    raise error
+                if hit is None:
+                    done[i] = True
+                    left -= 1
+                elif not self.ordered or i == current:
+                    yield hit
+                else:
+                    waiting[i].append(hit)
+                while self.ordered and current < n and done[current]:
+                    current += 1
+                    if current < n:
+                        for hit in waiting[current]:
+                            yield hit
+                        waiting[current] = []
+        finally:
+            if self.tmpdir is not None:
+                shutil.rmtree(self.tmpdir, True)
+
 if __name__ == '__main__':
     import sys
 
+    # the same hit as a tabular and as an XML report.
+    row = ['contig1', 'ref3 a protein [org]', '900', '120', '31', '90', '5',
+           '24', '2e-30', '80.5', '195', '20', '18', '19', '0', '1', '0',
+           'MKVLAAGIVGLLLSTPAWAQ', 'MKVLSAGIVGLLLATPAWAQ']
+    xml = '''<?xml version="1.0"?>
+<BlastOutput>
+<BlastOutput_program>blastx</BlastOutput_program>
+<BlastOutput_iterations><Iteration>
+<Iteration_query-ID>Query_1</Iteration_query-ID>
+<Iteration_query-def>contig1</Iteration_query-def>
+<Iteration_query-len>900</Iteration_query-len>
+<Iteration_hits><Hit>
+<Hit_id>gnl|BL_ORD_ID|3</Hit_id>
+<Hit_def>ref3 a protein [org]</Hit_def>
+<Hit_len>120</Hit_len>
+<Hit_hsps><Hsp>
+<Hsp_bit-score>80.5</Hsp_bit-score><Hsp_score>195</Hsp_score>
+<Hsp_evalue>2e-30</Hsp_evalue>
+<Hsp_query-from>31</Hsp_query-from><Hsp_query-to>90</Hsp_query-to>
+<Hsp_hit-from>5</Hsp_hit-from><Hsp_hit-to>24</Hsp_hit-to>
+<Hsp_query-frame>1</Hsp_query-frame><Hsp_hit-frame>0</Hsp_hit-frame>
+<Hsp_identity>18</Hsp_identity><Hsp_positive>19</Hsp_positive>
+<Hsp_gaps>0</Hsp_gaps><Hsp_align-len>20</Hsp_align-len>
+<Hsp_qseq>MKVLAAGIVGLLLSTPAWAQ</Hsp_qseq>
+<Hsp_hseq>MKVLSAGIVGLLLATPAWAQ</Hsp_hseq>
+</Hsp></Hit_hsps></Hit></Iteration_hits>
+</Iteration></BlastOutput_iterations>
+</BlastOutput>
+'''
+    tab = [hit.todict() for hit in Result('\t'.join(row), 'tabular', 'blastx')]
+    assert tab == [hit.todict() for hit in Result(xml, 'xml')]
+    assert tab[0]['frame'] == '+1' and tab[0]['subject']['name'] == 'ref3'
+    assert tab[0]['identities'] == '18/20 (90%)'
+    assert not list(Result('\t'.join(row), 'tabular', min_identity=0.95))
+
+    # a query file split three ways, and the hits of its pieces in order.
+    tmpdir = tempfile.mkdtemp()
+    records = ['>contig%d\n%s\n' % (i, 'ACGT' * i) for i in range(1, 40)]
+    with open(tmpdir + sep + 'q.fasta', 'w') as fh:
+        fh.write(''.join(records))
+    names = _shard(tmpdir + sep + 'q.fasta', 3, tmpdir)
+    pieces = [open(name).read() for name in names]
+    assert len(names) == 3 and ''.join(pieces) == ''.join(records)
+    assert all(piece.startswith('>') for piece in pieces)
+    shards = [[['contig%d_%d' % (i, k)] + row[1:] for k in range(n)]
+              for i, n in enumerate((500, 3, 7))]
+    results = [Result('\n'.join('\t'.join(r) for r in rows), 'tabular')
+               for rows in shards]
+    hits = list(ShardedResult(results, True, tmpdir))
+    assert [hit.query.name for hit in hits] == \
+        [r[0] for rows in shards for r in rows]
+    assert not exists(tmpdir)
+
+    # a registered database, then its sequence file touched and changed.
+    from os import utime, remove
+    tmpdir = tempfile.mkdtemp()
+    source, db = tmpdir + sep + 'refs.fasta', tmpdir + sep + 'refs'
+    with open(source, 'w') as fh:
+        fh.write('>ref1\nMKVLAAGIVG\n')
+    open(db + '.pin', 'w').close()
+    registry = DatabaseRegistry(tmpdir + sep + 'registry.db')
+    assert registry.get(source) is None
+    registry.put(source, db, 'prot')
+    assert registry.get(source) == (db, 'prot', True) and len(registry) == 1
+    utime(source, (getmtime(source) + 10, getmtime(source) + 10))
+    assert registry.get(source) == (db, 'prot', True)
+    with open(source, 'w') as fh:
+        fh.write('>ref1\nMKVLAAGIVA\n')
+    utime(source, (getmtime(source) + 20, getmtime(source) + 20))
+    assert registry.get(source) == (db, 'prot', False)
+    registry.put(source, db, 'prot')
+    assert registry.get(source) == (db, 'prot', True)
+    remove(db + '.pin')
+    assert registry.get(source) is None and len(registry) == 0
+    shutil.rmtree(tmpdir, True)
+
     if len(sys.argv) > 1:
         output = open(sys.argv[1]).read()
         for result in Result(output):
-            print(result)
+            print(result.todict())
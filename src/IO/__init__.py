@@ -5,6 +5,7 @@ supported file types are: FASTA, FASTQ, CLUSTAL alignments, and GFF3 files.
 
 from biotools.IO import fasta, fastq, gff, clustal
 from biotools.IO.manager import IOManager
+from biotools.sequence import compact as compact_sequence
 try:
     import __builtin__
 except ImportError:
@@ -104,12 +105,15 @@ class IOBase(object):
 
 class Reader(IOBase):
     '''
-    A class that wraps IOBase and restricts the ability to write.
+    A class that wraps IOBase and restricts the ability to write. If
+    `compact` is truthy, sequences are read as `CompactSequence`s.
     '''
-    def __init__(self, filename, mode='r'):
+    def __init__(self, filename, mode='r', compact=False):
         IOBase.__init__(self, filename, mode)
         self.method['rhook'](self.handle)
         self.iter = self.method['read'](self.handle)
+        if compact:
+            self.iter = (compact_sequence(s) for s in self.iter)
 
     def read(self, n=None):
         '''
@@ -152,13 +156,14 @@ class Writer(IOBase):
         self.method['write'](self.handle, sequence)
 
 
-def open(filename, mode='r'):
+def open(filename, mode='r', compact=False):
     '''
     Open a file for parsing or creation. Returns either a Reader or Writer
-    object, depending on the open mode.
+    object, depending on the open mode. When reading, `compact` can be set to
+    get `CompactSequence`s, which use less memory, instead of `Sequence`s.
     '''
     if mode == 'r':
-        return Reader(filename)
+        return Reader(filename, compact=compact)
     if mode == 'w':
         return Writer(filename, mode='w')
     if mode == 'a':
@@ -9,8 +9,12 @@ that best aligns to a reference.
 
 from biotools.translate import translate
 import biotools.analysis.options as options
+from biotools.matrix import from_dict
+import numpy as np
 
 DIAG_MARK, VGAP_MARK, HGAP_MARK = 3, 2, 1
+COMPACT_CELLS = 1 << 22
+_UNREACHABLE = -(1 << 40)
 bl = {
  '*': {'*': 0, 'A': -9, 'C': -9, 'E': -9, 'D': -9, 'G': -9, 'F': -9, 'I': -9,
        'H': -9, 'K': -9, 'M': -9, 'L': -9, 'N': -9, 'Q': -9, 'P': -9, 'S': -9,
@@ -81,7 +85,294 @@ bl = {
 }
 
 
-def OptimalCTether(reference, translation, extend=1, create=10):
+BLOSUM62 = from_dict(bl)
+
+
+def _store(pnt, a, col, marks, compact):
+    '''
+    Sets the pointers of the cells in rows `a` and columns `col` of the
+    pointer matrix. The cells must not have been set before.
+    '''
+
+    if compact:
+        np.bitwise_or.at(pnt, (a, col >> 2),
+                         (marks << 2 * (col & 3)).astype(np.uint8))
+    else:
+        pnt[a, col] = marks
+
+
+def _fill(v, w, starts, extend, create, matrix, compact=False, band=None):
+    '''
+    Fills in the alignment matrix of the (reversed) strings `v` and `w` one
+    anti-diagonal at a time, since each cell only depends on the cells of
+    the two anti-diagonals before it. Only those two anti-diagonals of the
+    score and gap matrices are kept, each stored by its row. Returns the
+    matrix of pointers and the best score along with the cell it is in.
+    Residues are scored by `matrix`, a `biotools.matrix.ScoringMatrix`,
+    using the query profile of `w`. If `compact` is true, the pointers are
+    packed two bits to a cell (see `_mark`).
+
+    If a `band` `(lo, hi)` is given, only the cells `(i, j)` with
+    `lo <= j - i <= hi` are filled in, and the pointer of cell `(i, j)` is
+    kept in column `j - i - lo` of the pointer matrix rather than column `j`.
+    '''
+
+    lv, lw = len(v), len(w)
+    vc, prof = matrix.encode(v), matrix.profile(w)[:, ::-1]
+    wi = np.arange(lw)
+    rows = np.array([False] + [abs(lv - i) / float(lv) <= options.LENGTH_ERR
+                               for i in range(lv)])
+    cols = np.array([False] + [c in starts for c in w])[::-1]
+    if band is None:
+        lo, hi, shift, base = -lv, lw, 0, 0
+    else:
+        lo, hi = band
+        shift, base = 1, lo
+
+    width = lw + 1 if band is None else hi - lo + 1
+    if compact:
+        pnt = np.zeros((lv + 1, width // 4 + 1), dtype=np.uint8)
+    else:
+        pnt = np.empty((lv + 1, width), dtype=np.uint8)
+    b = np.arange(min(lw, hi) + 1)
+    a = np.arange(1, min(lv, -lo) + 1)
+    _store(pnt, 0 * b, b - base, np.where(b, VGAP_MARK, DIAG_MARK), compact)
+    _store(pnt, a, -shift * a - base, HGAP_MARK + 0 * a, compact)
+
+    mat = [np.zeros(lv + 1, dtype=np.int64) for _ in range(3)]
+    gpc = [np.zeros(lv + 1, dtype=np.int64) for _ in range(2)]
+    mat[2][0] = -create * (w[0] != v[0])
+    optimal = [None, 0, 0]
+
+    for d in range(1, lv + lw + 1):
+        mat = [mat[1], mat[2], mat[0]]
+        gpc = [gpc[1], gpc[0]]
+        prev2, prev, cur = mat
+        gprev, gcur = gpc
+        if d <= min(lw, hi):
+            cur[0], gcur[0] = -d * extend, 0
+        if d <= min(lv, -lo):
+            cur[d], gcur[d] = -d * extend, 0
+
+        a1 = max(1, d - lw, -((hi - d) // 2))
+        a2 = min(d - 1, lv, (d - lo) // 2)
+        if a1 > a2:
+            continue
+        b1, b2 = lw - d + a1, lw - d + a2 + 1
+        diag = prev2[a1 - 1:a2] + prof[vc[a1 - 1:a2], wi[b1:b2]]
+        vgap = prev[a1:a2 + 1] - extend - gprev[a1:a2 + 1]
+        hgap = prev[a1 - 1:a2] - extend - gprev[a1 - 1:a2]
+        # cells on the edges of the band can't be reached from outside it.
+        if d - 2 * a1 == hi:
+            hgap[0] = _UNREACHABLE
+        if d - 2 * a2 == lo:
+            vgap[-1] = _UNREACHABLE
+        gap = np.maximum(vgap, hgap)
+        isdiag = diag >= gap
+        cur[a1:a2 + 1] = np.where(isdiag, diag, gap)
+        gcur[a1:a2 + 1] = create * isdiag
+        a = np.arange(a1, a2 + 1)
+        marks = np.where(isdiag, DIAG_MARK,
+                         np.where(vgap >= hgap, VGAP_MARK, HGAP_MARK))
+        col = d - a - shift * a - base
+        if compact:
+            pnt[a, col >> 2] |= (marks << 2 * (col & 3)).astype(np.uint8)
+        else:
+            pnt[a, col] = marks
+
+        # the best cell is the first one in row-major order, as it would be
+        # if the matrix were filled in one row at a time.
+        ok = rows[a1:a2 + 1] & cols[b1:b2]
+        if ok.any():
+            vals = cur[a1:a2 + 1][ok]
+            k = np.argmax(vals)
+            score, i = vals[k], a[ok][k]
+            if optimal[0] is None or score > optimal[0] or \
+                    (score == optimal[0] and i < optimal[1]):
+                optimal = [int(score), int(i), int(d - i)]
+    return pnt, optimal
+
+
+def _fill_many(v, ws, starts, extend, create, matrix, compact=False):
+    '''
+    Fills in the alignment matrices of the (reversed) string `v` against
+    each of the (reversed) strings `ws` at the same time, in the same way as
+    `_fill`. The strings in `ws` are padded to the length of the longest;
+    cells past the end of a string are filled in, but never used. Scores are
+    looked up in the rows of `matrix` for the residues of `v`, which are only
+    found once. Returns the pointer matrices (one per string, stacked) and
+    the best score and cell for each string.
+    '''
+
+    lv, count = len(v), len(ws)
+    lw = max(len(w) for w in ws)
+    prof = matrix.scores[matrix.encode(v)]
+    codes = np.zeros((count, lw), dtype=np.intp)
+    cols = np.zeros((count, lw + 1), dtype=bool)
+    for k, w in enumerate(ws):
+        codes[k, :len(w)] = matrix.encode(w)
+        cols[k, 1:len(w) + 1] = [c in starts for c in w]
+    rows = np.array([False] + [abs(lv - i) / float(lv) <= options.LENGTH_ERR
+                               for i in range(lv)])
+
+    if compact:
+        pnt = np.zeros((count, lv + 1, lw // 4 + 1), dtype=np.uint8)
+    else:
+        pnt = np.empty((count, lv + 1, lw + 1), dtype=np.uint8)
+    b = np.arange(lw + 1)
+    a = np.arange(1, lv + 1)
+    for k in range(count):
+        _store(pnt[k], 0 * b, b, np.where(b, VGAP_MARK, DIAG_MARK), compact)
+        _store(pnt[k], a, 0 * a, HGAP_MARK + 0 * a, compact)
+
+    mat = [np.zeros((count, lv + 1), dtype=np.int64) for _ in range(3)]
+    gpc = [np.zeros((count, lv + 1), dtype=np.int64) for _ in range(2)]
+    mat[2][:, 0] = [-create * (w[0] != v[0]) for w in ws]
+    best = np.zeros(count, dtype=np.int64)
+    besti = np.zeros(count, dtype=np.intp)
+    bestj = np.zeros(count, dtype=np.intp)
+    found = np.zeros(count, dtype=bool)
+    everyone = np.arange(count)
+
+    for d in range(1, lv + lw + 1):
+        mat = [mat[1], mat[2], mat[0]]
+        gpc = [gpc[1], gpc[0]]
+        prev2, prev, cur = mat
+        gprev, gcur = gpc
+        if d <= lw:
+            cur[:, 0], gcur[:, 0] = -d * extend, 0
+        if d <= lv:
+            cur[:, d], gcur[:, d] = -d * extend, 0
+
+        a1, a2 = max(1, d - lw), min(d - 1, lv)
+        if a1 > a2:
+            continue
+        a = np.arange(a1, a2 + 1)
+        b = d - a
+        diag = prev2[:, a1 - 1:a2] + prof[a - 1, codes[:, b - 1]]
+        vgap = prev[:, a1:a2 + 1] - extend - gprev[:, a1:a2 + 1]
+        hgap = prev[:, a1 - 1:a2] - extend - gprev[:, a1 - 1:a2]
+        gap = np.maximum(vgap, hgap)
+        isdiag = diag >= gap
+        cur[:, a1:a2 + 1] = np.where(isdiag, diag, gap)
+        gcur[:, a1:a2 + 1] = create * isdiag
+        marks = np.where(isdiag, DIAG_MARK,
+                         np.where(vgap >= hgap, VGAP_MARK, HGAP_MARK))
+        if compact:
+            pnt[:, a, b >> 2] |= (marks << 2 * (b & 3)).astype(np.uint8)
+        else:
+            pnt[:, a, b] = marks
+
+        ok = rows[a1:a2 + 1] & cols[:, b]
+        if ok.any():
+            vals = np.where(ok, cur[:, a1:a2 + 1], _UNREACHABLE)
+            k = vals.argmax(axis=1)
+            score, i = vals[everyone, k], a[k]
+            better = ok.any(axis=1) & (~found | (score > best) |
+                                       ((score == best) & (i < besti)))
+            best[better], besti[better] = score[better], i[better]
+            bestj[better], found[better] = d - i[better], True
+
+    return pnt, [[int(best[k]) if found[k] else None, int(besti[k]),
+                  int(bestj[k])] for k in range(count)]
+
+
+def _mark(pnt, i, j):
+    '''
+    The pointer of cell `(i, j)` of a packed pointer matrix, where each byte
+    holds the pointers of four cells of a row, the first in the low bits.
+    '''
+
+    return (int(pnt[i, j >> 2]) >> 2 * (j & 3)) & 3
+
+
+def _traceback(v, w, pnt, i, j, compact=False, band=None):
+    '''
+    Follows the pointers back from cell `(i, j)` to the corner, counting
+    gaps and identities along the way. Also gives the lowest and highest
+    diagonals (`j - i`) that the path goes through.
+    '''
+
+    shift, base = (0, 0) if band is None else (1, band[0])
+    subject, query = [], []
+    gapcount, length, sublen, ids = 0, 0, 0, 0
+    lowest = highest = j - i
+    while i or j:
+        length += 1
+        lowest, highest = min(lowest, j - i), max(highest, j - i)
+        col = j - shift * i - base
+        mark = _mark(pnt, i, col) if compact else pnt[i, col]
+        if mark == DIAG_MARK:
+            subject.append(v[i - 1])
+            query.append(w[j - 1])
+            ids += w[j - 1] == v[i - 1]
+            sublen += 1
+            i, j = i - 1, j - 1
+        elif mark == VGAP_MARK:
+            subject.append('-')
+            query.append(w[j - 1])
+            gapcount += 1
+            sublen += 1
+            j -= 1
+        else:
+            subject.append(v[i - 1])
+            query.append('-')
+            gapcount += 1
+            i -= 1
+    return {
+        'subject': ''.join(subject),
+        'query': ''.join(query),
+        'gaps': gapcount,
+        'length': length,
+        'sublength': sublen,
+        'identities': ids
+    }, (lowest, highest)
+
+
+def _string(seq):
+    '''
+    The string of a `Sequence`, or the string itself.
+    '''
+
+    try:
+        return seq.seq
+    except AttributeError:
+        return seq
+
+
+def _prepare(reference, translation):
+    '''
+    The start codons (translated) and the reversed strings of a reference
+    and translation, checking that the translation has a start codon.
+    '''
+
+    starts = set(translate(s, options.GENETIC_CODE)
+                 for s in options.START_CODONS)
+    v, w = _string(reference), _string(translation)
+    if not starts & set(w):
+        raise ValueError("Open reading frame does not contain a start codon.")
+    return starts, v[::-1], w[::-1]
+
+
+def _align(v, w, starts, extend, create, compact, matrix, band=None):
+    '''
+    Aligns the reversed strings `v` and `w`; see `OptimalCTether`. Returns
+    the result along with the range of diagonals its path goes through.
+    '''
+
+    if compact is None:
+        width = len(w) + 1 if band is None else band[1] - band[0] + 1
+        compact = (len(v) + 1) * width > COMPACT_CELLS
+    pnt, optimal = _fill(v, w, starts, extend, create, matrix or BLOSUM62,
+                         compact, band)
+    result, path = _traceback(v, w, pnt, optimal[1], optimal[2], compact,
+                              band)
+    result['score'] = optimal[0]
+    return result, path
+
+
+def OptimalCTether(reference, translation, extend=1, create=10,
+                   compact=None, matrix=None):
     '''
     This function will take two sequences: a `reference` sequence and  another
     protein sequence (`translation`; usually, this is an open reading frame
@@ -94,71 +385,130 @@ def OptimalCTether(reference, translation, extend=1, create=10):
     the score [key: `score`], the length of the alignment [key: `length`], the
     length of the substring of translation used [key: `sublength`], the number
     of identities [key: `identities`], and the number of gaps [key: `gaps`].
+
+    Only the pointers of the alignment matrix are kept in full, as one byte
+    per cell; if `compact` is true they are packed into two bits per cell
+    instead, which takes a quarter of the memory but is a little slower. By
+    default, this is done for alignments of more than `COMPACT_CELLS` cells.
+
+    Residues are scored with `matrix`, a `biotools.matrix.ScoringMatrix`,
+    which is BLOSUM62 unless otherwise given.
     '''
 
-    starts = set(translate(s) for s in options.START_CODONS)
-    v, w = reference, translation
+    starts, v, w = _prepare(reference, translation)
+    return _align(v, w, starts, extend, create, compact, matrix)[0]
 
-    try:
-        v = v.seq
-    except AttributeError:
-        pass
-    try:
-        w = w.seq
-    except AttributeError:
-        pass
-    if not starts & set(w):
-        raise ValueError("Open reading frame does not contain a start codon.")
 
-    v, w = v[::-1], w[::-1]
+def BandedCTether(reference, translation, offset, width=32, extend=1,
+                  create=10, compact=None, matrix=None):
+    '''
+    Does the same alignment as `OptimalCTether`, but only near the diagonal
+    on which `reference[i]` lines up with `translation[i + offset]` (e.g.,
+    where BLAST found them to line up): `width` diagonals to either side of
+    it, and of the diagonals between it and those on which the C-termini
+    and the N-termini line up. The alignment found is only kept if it stays
+    more than `width / 2` diagonals away from the edges of the band, so that
+    a band half as wide would have given it the same score; otherwise the
+    band is made twice as wide and the alignment is done again. The result
+    is then almost always the same as that of `OptimalCTether` (only the
+    whole matrix makes sure of it), in time proportional to the width of
+    the band rather than the length of the translation.
+    '''
+
+    starts, v, w = _prepare(reference, translation)
     lv, lw = len(v), len(w)
-    rv, rw = range(lv + 1), range(lw + 1)
-    gpc = [[create * int(not (i | j)) for i in rw] for j in rv]
-    mat = [[-(i + j) * extend - create * (not (i | j) and w[0] != v[0])
-           for i in rw] for j in rv]
-    pnt = [[VGAP_MARK if i > j else HGAP_MARK if j > i else DIAG_MARK
-           for i in rw] for j in rv]
-    ids = [[0 for i in rw] for j in rv]
-    optimal = [None, 0, 0]
-    for i in range(lv):
-        for j in range(lw):
-            vals = [[mat[i][j] + bl[v[i]][w[j]], DIAG_MARK],
-                    [mat[i + 1][j] - extend - gpc[i + 1][j], VGAP_MARK],
-                    [mat[i][j + 1] - extend - gpc[i][j + 1], HGAP_MARK]]
-            mat[i + 1][j + 1], pnt[i + 1][j + 1] = max(vals)
-            gpc[i + 1][j + 1] = create * int(pnt[i + 1][j + 1] == DIAG_MARK)
-            if (optimal[0] is None or mat[i + 1][j + 1] > optimal[0]) and \
-                    abs(lv - i) / float(lv) <= options.LENGTH_ERR and \
-                    w[j] in starts:
-                optimal = [mat[i + 1][j + 1], i + 1, j + 1]
-
-    i, j = optimal[1], optimal[2]
-    seq, ids = ['', ''], 0
-    gapcount, length, sublen = 0, 0, 0
-    methods = {
-        VGAP_MARK:
-            lambda s, i, j, l, g, n:
-                (['-' + s[0], w[j - 1] + s[1]], i, j - 1, l + 1, g + 1, n),
-        DIAG_MARK:
-            lambda s, i, j, l, g, n:
-                ([v[i - 1] + s[0], w[j - 1] + s[1]], i - 1, j - 1,
-                 l + 1, g, n + (w[j - 1] == v[i - 1])),
-        HGAP_MARK:
-            lambda s, i, j, l, g, n:
-                ([v[i - 1] + s[0], '-' + s[1]], i - 1, j, l, g + 1, n)
-    }
-
-    while [i, j] != [0, 0]:
-        length += 1
-        state = (seq, i, j, sublen, gapcount, ids)
-        seq, i, j, sublen, gapcount, ids = methods[pnt[i][j]](*state)
+    ends = [lw - lv - offset, 0, lw - lv]
+    width = max(width, 2)
+    while 1:
+        lo = max(min(ends) - width, -lv)
+        hi = min(max(ends) + width, lw)
+        if lo == -lv and hi == lw:
+            return _align(v, w, starts, extend, create, compact, matrix)[0]
+        result, (lowest, highest) = _align(v, w, starts, extend, create,
+                                           compact, matrix, (lo, hi))
+        # a better alignment can lie wholly outside of a band, so this one
+        # has to be the best in a band half as wide as well before it is kept.
+        half = width // 2
+        if result['score'] is not None and \
+                (lowest - half > lo or lo == -lv) and \
+                (highest + half < hi or hi == lw):
+            return result
+        width *= 2
 
-    return {
-        'subject': seq[0][::-1],
-        'query': seq[1][::-1],
-        'score': optimal[0],
-        'gaps': gapcount,
-        'length': length,
-        'sublength': sublen,
-        'identities': ids
-    }
+
+def align_many(reference, translations, extend=1, create=10, compact=None,
+               matrix=None):
+    '''
+    Aligns each of the `translations` to the `reference` and gives the list
+    of results that calling `OptimalCTether` on each one would, but does all
+    of the alignments at once, one anti-diagonal at a time. The reference is
+    only reversed and encoded once. The translations are padded to the
+    length of the longest, so this works best for translations of similar
+    lengths, like the ORFs overlapping a BLAST hit.
+    '''
+
+    starts = set(translate(s, options.GENETIC_CODE)
+                 for s in options.START_CODONS)
+    v = _string(reference)[::-1]
+    ws = [_string(w) for w in translations]
+    if not ws:
+        return []
+    for w in ws:
+        if not starts & set(w):
+            raise ValueError("Open reading frame does not contain a start " +
+                             "codon.")
+    ws = [w[::-1] for w in ws]
+
+    if compact is None:
+        cells = len(ws) * (len(v) + 1) * (max(len(w) for w in ws) + 1)
+        compact = cells > COMPACT_CELLS
+    pnt, optima = _fill_many(v, ws, starts, extend, create,
+                             matrix or BLOSUM62, compact)
+    results = []
+    for k, (w, optimal) in enumerate(zip(ws, optima)):
+        result = _traceback(v, w, pnt[k], optimal[1], optimal[2], compact)[0]
+        result['score'] = optimal[0]
+        results.append(result)
+    return results
+
+
+def identity_bound(reference, translation):
+    '''
+    An upper bound on the fraction of identities (`identities / length`) in
+    the alignment that `OptimalCTether` would give, found without aligning
+    the sequences: the alignment covers all but `LENGTH_ERR` of the
+    reference, and can have no more identities than the residues that the
+    two sequences have in common.
+    '''
+
+    v, w = _string(reference), _string(translation)
+    lv = len(v)
+    rows = [i + 1 for i in range(lv)
+            if abs(lv - i) / float(lv) <= options.LENGTH_ERR]
+    if not rows:
+        return 1.0
+    size = len(BLOSUM62)
+    common = np.minimum(np.bincount(BLOSUM62.encode(v), minlength=size),
+                        np.bincount(BLOSUM62.encode(w), minlength=size))
+    return min(float(min(common.sum(), len(w))) / rows[0], 1.0)
+
+
+
+if __name__ == '__main__':
+    # the start codon is well upstream of where BLAST lined them up.
+    head = 'MSEKYIVTWDMLQIHARKLASRLMPSEQWKG'
+    tail = 'IIAVSRGGLVPGALLARELGIRHVDTVCISSYDHDNQRELKVLKRAEGDGEGFIVIDDLV' \
+           'DTGGTAVAIREMYPKAHFVTIFAKPAGRPLVDDYVVDIPQDTWIEQPWDMGVVFVPPISGR'
+    ref, orf = head + tail, 'LR' + head + 'PEDTNQKHGRSLFWE' + tail + 'NK'
+    best = OptimalCTether(ref, orf)
+    assert best['score'] == 766
+    for width in (1, 4, 8):
+        assert BandedCTether(ref, orf, 17, width) == best
+    assert align_many(ref, [orf]) == [best]
+    # BLAST's diagonal is 4 off from the best alignment's.
+    ref = 'MDSMEWFRHRPDNPLWAQCLEVIHENFPMDEDAQMPNTQWQRNDNFKPEHSVSEIVVQWVSW' \
+          'KVENPLGPMNSMLSVSTRYFDEQ'
+    orf = 'CWDSEWFRHRPDNPLAQCLSIIRHYNFFMDEDAQMPNTQQANDNFKPEHSVSEIVFVQWVS' \
+          'WKVEQNPILGPMNSMLSVSTRYFDQW'
+    assert BandedCTether(ref, orf, 4, 1) == OptimalCTether(ref, orf)
+    print(best['score'])
@@ -52,7 +52,7 @@ def run(direc, inputs):
                         nm = name + '_' + str(counter)
                         seq = cluster[1]
                         curr = sequ.Sequence(nm, seq, defline=', '.join(cid))
-                        tr = tran.translate(curr)
+                        tr = tran.translate(curr, options.GENETIC_CODE)
                         tr.name = curr.name
                         fh.write(curr)
                         ah.write(tr)
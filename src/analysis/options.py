@@ -1,3 +1,4 @@
+from biotools.translate import tables, start_codons, stop_codons
 from optparse import OptionParser
 from threading import Lock
 from os import sep, makedirs
@@ -6,9 +7,20 @@ from sys import stderr
 LENGTH_ERR = 0.2
 MIN_IDENTITY = 0.45
 MAX_EVALUE = 1e-30
+BLAST_FORMAT = 'text'
+BLAST_SHARDS = 1
+BLAST_REGISTRY = None
 MIN_ORFLEN = 300
 NUM_THREADS = 16
 NUM_PROCESSES = 2
+ALIGN_PROCESSES = 0
+TRANSLATION_CACHE = 256
+ORF_WINDOW = 0
+BAND_WIDTH = 0
+MATRIX = None
+GENETIC_CODE = 1
+ALIGNMENT_CACHE = None
+ALIGNMENT_CACHE_SIZE = 100000
 DIRECTORY = '.' + sep
 PLOTTER = 'biotools.analysis.plot'
 
@@ -29,13 +41,21 @@ lock = Lock()
 parser = OptionParser(usage="Usage: %prog [options] " +
                       "<database> <sequences ...>")
 parser.add_option("-S", "--start", action="append", dest="start",
-                  default=START_CODONS, type="string",
-                  help="define a start codon [default: %s]" %
-                  ' '.join("-S " + s for s in START_CODONS))
+                  default=None, type="string",
+                  help="define a start codon [default: %s, or those of " %
+                  ' '.join("-S " + s for s in START_CODONS) +
+                  "the genetic code]")
 parser.add_option("-E", "--stop", action="append", dest="stop",
-                  default=STOP_CODONS, type="string",
-                  help="define a stop codon [default: %s]" %
-                  ' '.join("-E " + s for s in STOP_CODONS))
+                  default=None, type="string",
+                  help="define a stop codon [default: %s, or those of " %
+                  ' '.join("-E " + s for s in STOP_CODONS) +
+                  "the genetic code]")
+parser.add_option("--table", action="store", dest="table",
+                  metavar="CODE", default=None, type="int",
+                  help="NCBI genetic code to translate with, e.g. 11 for " +
+                  "bacteria; its start and stop codons are used as well " +
+                  "[default: the standard code, with only ATG as a start " +
+                  "codon]")
 parser.add_option("-j", "--threads", action="store", dest="threads",
                   default=NUM_THREADS, type="int",
                   help="number of threads [default: %default]")
@@ -43,9 +63,29 @@ parser.add_option("-p", "--processes", action="store", dest="processes",
                   default=NUM_PROCESSES, type="int",
                   help="number of parallel processes to run " +
                   "[default: %default]")
+parser.add_option("--align-processes", action="store",
+                  dest="align_processes", default=ALIGN_PROCESSES,
+                  type="int", help="number of worker processes to align " +
+                  "BLAST hits with, 0 to align them with threads " +
+                  "[default: %default]")
 parser.add_option("-e", "--evalue", action="store", dest="evalue",
                   default=MAX_EVALUE, type="float",
                   help="maximum e-value [default: %default]")
+parser.add_option("--blast-format", action="store", dest="blast_format",
+                  default=BLAST_FORMAT, type="choice",
+                  choices=['text', 'tabular', 'xml'],
+                  help="format to have BLAST report its hits in: text, " +
+                  "tabular (quickest to read, but without the query " +
+                  "definition lines) or xml [default: %default]")
+parser.add_option("--blast-shards", action="store", dest="blast_shards",
+                  default=BLAST_SHARDS, type="int",
+                  help="number of pieces to split the sequences into, " +
+                  "each BLASTed in its own process [default: %default]")
+parser.add_option("--blast-registry", action="store",
+                  dest="blast_registry", metavar="FILE",
+                  default=BLAST_REGISTRY, type="string",
+                  help="remember which BLAST databases were made from " +
+                  "which files in this file [default: none]")
 parser.add_option("-I", "--identity", action="store", dest="identity",
                   default=MIN_IDENTITY, type="float",
                   help="minimum percent identity [default: %default]")
@@ -56,12 +96,40 @@ parser.add_option("-L", "--length", action="store", dest="fraction",
 parser.add_option("-O", "--orflen", action="store", dest="orflen",
                   metavar="bases", default=MIN_ORFLEN, type="int",
                   help="minimum allowable length for ORFs [default: %default]")
+parser.add_option("--orf-window", action="store", dest="orf_window",
+                  metavar="bases", default=ORF_WINDOW, type="int",
+                  help="only look for ORFs within this many bases of a " +
+                  "BLAST hit, 0 for the whole contig [default: %default]")
+parser.add_option("--band-width", action="store", dest="band_width",
+                  metavar="RESIDUES", default=BAND_WIDTH, type="int",
+                  help="only align ORFs within this many diagonals of " +
+                  "where BLAST lined them up, 0 to align them in full " +
+                  "[default: %default]")
+parser.add_option("--matrix", action="store", dest="matrix",
+                  metavar="FILE", default=MATRIX, type="string",
+                  help="substitution matrix file (NCBI format) to score " +
+                  "alignments with [default: BLOSUM62]")
 parser.add_option("-d", "--directory", action="store", dest="directory",
                   default=DIRECTORY, type="string",
                   help="set working directory [default: current]")
 parser.add_option("-P", "--plotter", action="store", dest="plotter",
                   default=PLOTTER, type="string",
                   help="plotting module [default: %default]")
+parser.add_option("--translation-cache", action="store",
+                  dest="translation_cache", metavar="SEQUENCES",
+                  default=TRANSLATION_CACHE, type="int",
+                  help="number of sequences whose translated frames are " +
+                  "kept in memory [default: %default]")
+parser.add_option("--alignment-cache", action="store",
+                  dest="alignment_cache", metavar="FILE",
+                  default=ALIGNMENT_CACHE, type="string",
+                  help="keep alignments in this file, to be reused by " +
+                  "later runs [default: none]")
+parser.add_option("--alignment-cache-size", action="store",
+                  dest="alignment_cache_size", metavar="ALIGNMENTS",
+                  default=ALIGNMENT_CACHE_SIZE, type="int",
+                  help="number of alignments to keep in the alignment " +
+                  "cache [default: %default]")
 parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
                   default=verbose,
                   help="print debug messages [default: False]")
@@ -106,18 +174,31 @@ def parse(pargs):
     * `LENGTH_ERR`
     * `MIN_IDENTITY`
     * `MAX_EVALUE`
+    * `BLAST_FORMAT`
+    * `BLAST_SHARDS`
+    * `BLAST_REGISTRY`
     * `NUM_THREADS`
     * `NUM_PROCESSES`
+    * `ALIGN_PROCESSES`
+    * `TRANSLATION_CACHE`
+    * `ORF_WINDOW`
+    * `BAND_WIDTH`
+    * `MATRIX`
+    * `GENETIC_CODE`
+    * `ALIGNMENT_CACHE`
+    * `ALIGNMENT_CACHE_SIZE`
     * `START_CODONS`
-    * `START_CODONS`
+    * `STOP_CODONS`
     * `DIRECTORY`
     * `PLOTTER`
     * `args`
     '''
     global \
-        LENGTH_ERR, MIN_IDENTITY, MAX_EVALUE, MIN_ORFLEN, \
-        NUM_THREADS, NUM_PROCESSES, START_CODONS, STOP_CODONS, \
-        DIRECTORY, PLOTTER, args, predicting, clustering, \
+        LENGTH_ERR, MIN_IDENTITY, MAX_EVALUE, BLAST_FORMAT, BLAST_SHARDS, \
+        BLAST_REGISTRY, MIN_ORFLEN, NUM_THREADS, NUM_PROCESSES, \
+        ALIGN_PROCESSES, TRANSLATION_CACHE, ORF_WINDOW, BAND_WIDTH, MATRIX, \
+        GENETIC_CODE, ALIGNMENT_CACHE, ALIGNMENT_CACHE_SIZE, START_CODONS, \
+        STOP_CODONS, DIRECTORY, PLOTTER, args, predicting, clustering, \
         renaming, calculating, reporting, plotting, verbose
 
     opts, largs = parser.parse_args(pargs)
@@ -129,6 +210,15 @@ def parse(pargs):
     except OSError:
         pass
 
+    if opts.table is None:
+        starts, stops = START_CODONS, STOP_CODONS
+    elif opts.table in tables:
+        starts, stops = start_codons(opts.table), stop_codons(opts.table)
+    else:
+        raise RuntimeError("Unknown genetic code: %d." % opts.table)
+    opts.start = list(starts) + (opts.start or [])
+    opts.stop = list(stops) + (opts.stop or [])
+
     if '*' in opts.start:
         DNA = 'ATCG'
         opts.start = set(i + j + k for i in DNA for j in DNA for k in DNA) - \
@@ -141,9 +231,20 @@ def parse(pargs):
     LENGTH_ERR = opts.fraction
     MIN_IDENTITY = opts.identity
     MAX_EVALUE = opts.evalue
+    BLAST_FORMAT = opts.blast_format
+    BLAST_SHARDS = opts.blast_shards
+    BLAST_REGISTRY = opts.blast_registry
     MIN_ORFLEN = opts.orflen
     NUM_THREADS = opts.threads
     NUM_PROCESSES = opts.processes
+    ALIGN_PROCESSES = opts.align_processes
+    TRANSLATION_CACHE = opts.translation_cache
+    ORF_WINDOW = opts.orf_window
+    BAND_WIDTH = opts.band_width
+    MATRIX = opts.matrix
+    GENETIC_CODE = opts.table or 1
+    ALIGNMENT_CACHE = opts.alignment_cache
+    ALIGNMENT_CACHE_SIZE = opts.alignment_cache_size
     STOP_CODONS = opts.stop
     START_CODONS = opts.start
     DIRECTORY = opts.directory
@@ -3,67 +3,775 @@ import biotools.IO as io
 import biotools.BLAST as BLAST
 import biotools.analysis.options as options
 from biotools.sequence import Sequence, annotation as ann
-from biotools.align import OptimalCTether as align
-from biotools.translate import translate
-from biotools.complement import complement
+from biotools.packed import pack
+from biotools.align import align_many, BandedCTether, identity_bound
+from biotools.translate import TranslationCache
+from biotools.cache import AlignmentCache
+from biotools.complement import revcomp
+from biotools.matrix import read as read_matrix
+from biotools.intervals import IntervalIndex
 try:
     import Queue as queue
 except ImportError:
     import queue
 import threading
-from os import sep, mkdir
+import time
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from os import sep, mkdir, rename
+from collections import OrderedDict
+import hashlib
+import numpy as np
 
-PIPING = True
+_STOP = object()
 
 
-def ORFGenerator(sequ):
+def _codon_tables(starts, stops):
+    '''
+    Builds the lookup tables used to find start and stop codons in bulk: a
+    table that maps each byte to a small code (0 for any character that is
+    not in a codon), and tables saying which codon indices are start and
+    stop codons. Codons are only matched exactly, as strings would be.
+    '''
+
+    codons = [c for c in list(starts) + list(stops) if len(c) == 3]
+    chars = sorted(set(''.join(codons)))
+    size = len(chars) + 1
+    charmap = np.zeros(256, dtype=np.intp)
+    for i, c in enumerate(chars):
+        charmap[ord(c)] = i + 1
+
+    def member(codons):
+        table = np.zeros(size ** 3, dtype=bool)
+        for c in codons:
+            if len(c) == 3:
+                a, b, c = (charmap[ord(x)] for x in c)
+                table[(a * size + b) * size + c] = True
+        return table
+
+    return charmap, size, member(starts), member(stops)
+
+
+def _orfs(seq, tables, mlen, partial=False):
+    '''
+    Finds the ORFs on one strand of a sequence string, in the same way as
+    `ORFGenerator`, but with array operations. Returns the positions of the
+    first base of the start codon and of the first base of the stop codon of
+    each ORF.
+    '''
+
+    charmap, size, isstart, isstop = tables
+    codes = charmap[np.frombuffer(seq, dtype=np.uint8)]
+    codons = (codes[:-2] * size + codes[1:-1]) * size + codes[2:]
+    stop = isstop[codons]
+    start = isstart[codons] & ~stop
+
+    first, last = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+    for f in range(3):
+        starts = np.flatnonzero(start[f::3]) * 3 + f
+        stops = np.flatnonzero(stop[f::3]) * 3 + f
+        if not len(starts) or not len(stops):
+            continue
+        # the ORF ending at each stop begins at the first start codon after
+        # the previous stop in the same frame, if there is one.
+        prev = np.concatenate(([-1], stops[:-1]))
+        nxt = np.searchsorted(starts, prev, side='right')
+        begin = starts[np.minimum(nxt, len(starts) - 1)]
+        keep = (nxt < len(starts)) & (begin < stops) & (stops - mlen >= begin)
+        if partial:
+            keep[0] = False
+        first.append(begin[keep])
+        last.append(stops[keep])
+    return np.concatenate(first), np.concatenate(last)
+
+
+def ORFGenerator(sequ, partial=False):
     '''
     Scans both strands of the given sequence and yields the longest subsequence
     that starts with a start codon and contains no stop codon other than the
-    final codon.
-    '''
-    comp = complement(sequ[::-1])
-    seq = sequ.seq
-    cseq = comp.seq
-    slen = len(sequ)
-    starts = [-1, 0, 1, -1, 0, 1]  # locations of start codons in each frame
-    stops = [0, 1, 2,  0, 1, 2]  # locations of stop  codons in each frame
+    final codon. If `partial` is true, the sequence is taken to be a piece of
+    a longer one, and ORFs whose start codon could lie before the piece are
+    skipped.
+    '''
+    comp = revcomp(sequ)
+    tables = _codon_tables(options.START_CODONS, options.STOP_CODONS)
     mlen = options.MIN_ORFLEN
 
-    for i in xrange(slen - 2):
-        fcodon, rcodon = seq[i:i + 3], cseq[i:i + 3]
-        if fcodon in options.STOP_CODONS:
-            if i - mlen >= starts[i % 3 + 3] >= stops[i % 3 + 3]:
-                yield sequ[starts[i % 3 + 3]:i + 3]
-            stops[i % 3 + 3] = i + 3
-        elif fcodon in options.START_CODONS:
-            if starts[i % 3 + 3] < stops[i % 3 + 3]:
-                starts[i % 3 + 3] = i
-        if rcodon in options.STOP_CODONS:
-            if i - mlen >= starts[i % 3] >= stops[i % 3]:
-                yield comp[starts[i % 3]:i + 3]
-            stops[i % 3] = i + 3
-        elif rcodon in options.START_CODONS:
-            if starts[i % 3] < stops[i % 3]:
-                starts[i % 3] = i
+    if len(sequ) < 3:
+        raise StopIteration()
+    fstart, fstop = _orfs(sequ.seq, tables, mlen, partial)
+    rstart, rstop = _orfs(comp.seq, tables, mlen, partial)
+
+    # ORFs come out in order of their stop codons, top strand first.
+    starts = np.concatenate((fstart, rstart))
+    stops = np.concatenate((fstop, rstop))
+    strands = np.concatenate((np.zeros(len(fstop), dtype=np.intp),
+                              np.ones(len(rstop), dtype=np.intp)))
+    for k in np.lexsort((strands, stops)):
+        s = sequ if strands[k] == 0 else comp
+        yield s[int(starts[k]):int(stops[k]) + 3]
     raise StopIteration()
 
 
-class ThreadQueue(queue.Queue):
+def in_range(seq, start, end, frame):
+    '''
+    Whether the ORF `seq` overlaps the BLAST hit from `start` to `end`, and
+    is in the same frame.
+    '''
+
+    ss, se = sorted((seq.start, seq.end))
+    os, oe = sorted((start, end))
+    frame = int(frame)
+
+    return (ss < oe and se > os and
+            (se % 3 == oe % 3 or ss % 3 == oe % 3) and
+            ((frame < 0 and seq.step < 0) or
+             (frame > 0 and seq.step > 0)))
+
+
+def _offset(orf, res, nucl=False):
+    '''
+    The offset between the translation of an ORF and the subject of a BLAST
+    hit on it, i.e., the number of residues before the one that lines up with
+    the first residue of the subject, according to the hit.
+    '''
+
+    sstart = res.subject.start - 1
+    if nucl:
+        sstart //= 3
+    return abs(res.query.start - orf.start) // 3 - sstart
+
+
+def _index(orfs):
+    '''
+    Indexes a list of ORFs by strand and position. Each ORF is kept along
+    with its place in the list, so that the order of the list can be kept.
+    '''
+
+    return dict((step, IntervalIndex((min(o.start, o.end), max(o.start, o.end),
+                                      (i, o)) for i, o in enumerate(orfs)
+                                     if o.step == step))
+                for step in (1, -1))
+
+
+class ORFFinder(object):
+    '''
+    Finds the ORFs of a set of contigs on demand. The ORFs of a contig are
+    only looked for the first time they are asked for, and are remembered
+    (along with an index of where they are) after that. If `window` is given,
+    only the ORFs within that many bases of the region asked for are looked
+    for (and are not remembered); ORFs that do not fit in the window are
+    missed. The number of names that `resolve` could not match to a contig
+    is kept in `unresolved`.
+    '''
+
+    def __init__(self, contigs, window=0):
+        self.contigs = contigs
+        self.window = window
+        self.orfs = {}
+        self.lock = threading.Lock()
+        self.lengths = sorted(set(len(name) for name in contigs if name),
+                              reverse=True)
+        self.names = {}
+        self.unresolved = 0
+
+    def __contains__(self, name):
+        return name in self.contigs
+
+    def resolve(self, name):
+        '''
+        The name of the contig that `name` refers to, i.e., the longest
+        contig name that `name` starts with (BLAST may have cut the name
+        short or run it into the definition line), or None if there is no
+        such contig. Only one lookup is made for each length of contig name,
+        and the answer is remembered.
+        '''
+
+        try:
+            return self.names[name]
+        except KeyError:
+            pass
+        for length in self.lengths:
+            if length <= len(name) and name[:length] in self.contigs:
+                found = name[:length]
+                break
+        else:
+            found = None
+            with self.lock:
+                self.unresolved += 1
+        self.names[name] = found
+        return found
+
+    def _lookup(self, name, start, end):
+        '''
+        The ORFs (and the index of them) of the contig `name` near the region
+        from `start` to `end`.
+        '''
+
+        contig = self.contigs[name]
+        if self.window and start is not None:
+            lo, hi = sorted((start, end))
+            lo, hi = max(lo - 1 - self.window, 0), hi + self.window
+            if lo > 0 or hi < len(contig):
+                orfs = list(ORFGenerator(contig[lo:hi], True))
+                return orfs, _index(orfs)
+
+        try:
+            return self.orfs[name]
+        except KeyError:
+            pass
+        orfs = list(ORFGenerator(contig))
+        options.debug("Found %d ORFs in %s." % (len(orfs), name))
+        with self.lock:
+            return self.orfs.setdefault(name, (orfs, _index(orfs)))
+
+    def find(self, name, start=None, end=None):
+        '''
+        The ORFs of the contig `name` near the (1-based, inclusive) region
+        from `start` to `end`, or all of them if no region is given.
+        '''
+
+        return self._lookup(name, start, end)[0]
+
+    def overlapping(self, name, start, end, frame):
+        '''
+        The ORFs of the contig `name` that overlap the BLAST hit from `start`
+        to `end` and are in the same frame (see `in_range`), in the order
+        `ORFGenerator` gives them.
+        '''
+
+        index = self._lookup(name, start, end)[1]
+        if int(frame) == 0:
+            return []
+        lo, hi = sorted((start, end))
+        hits = index[1 if int(frame) > 0 else -1].overlapping(lo, hi)
+        return [orf for _, orf in sorted(hits)
+                if in_range(orf, start, end, frame)]
+
+
+class Predictor(object):
+    '''
+    Finds the genes behind BLAST hits of the database sequences `subj` (a
+    dictionary of `Sequence`s by name) to the `contigs` (likewise). Each hit
+    is looked up and aligned on its own, so a `Predictor` can be shared by
+    several threads, or set up once in each of several processes.
+    '''
+
+    def __init__(self, subj, contigs):
+        self.subj = subj
+        self.frames = TranslationCache(options.TRANSLATION_CACHE,
+                                       options.GENETIC_CODE)
+        self.matrix = read_matrix(options.MATRIX) if options.MATRIX else None
+        self.cache = AlignmentCache(options.ALIGNMENT_CACHE,
+                                    options.ALIGNMENT_CACHE_SIZE) \
+            if options.ALIGNMENT_CACHE else None
+        self.orfs = ORFFinder(contigs, options.ORF_WINDOW)
+        self.counts = {'aligned': 0, 'pruned': 0}
+        self.lock = threading.Lock()
+
+    def predict(self, res):
+        '''
+        The gene (a `Sequence` on its contig) that best matches the BLAST
+        result `res`, or None if no ORF matches it well enough.
+        '''
+
+        subj, frames, matrix = self.subj, self.frames, self.matrix
+        aligner = self.cache.align_many if self.cache is not None \
+            else align_many
+        qname, sname = res.query.name, res.subject.name
+        start, end = res.query.start, res.query.end
+        max_match = (options.MIN_IDENTITY, -1, None)
+
+        if subj[sname].type == 'nucl':
+            subject = frames.translate(subj[sname])
+        else:
+            subject = subj[sname]
+
+        qname = self.orfs.resolve(qname)
+        if qname is None:
+            return None
+
+        candidates = [orf[:-3] for orf in
+                      self.orfs.overlapping(qname, start, end, res.frame)]
+        queries = [frames.translate(orf) for orf in candidates]
+        bounds = [identity_bound(subject.seq, query.seq) for query in queries]
+
+        # the ORFs with the best chance are aligned first, and any ORF that
+        # can't do better than the best so far is skipped. Of two equally
+        # good ORFs, the later one wins, as it always has. Unless the
+        # alignments are banded, the best candidate is aligned on its own
+        # and whatever it can't rule out is aligned in one batch.
+        order = sorted(range(len(candidates)), key=lambda k: -bounds[k])
+        size = 1
+        while order:
+            batch, order = order[:size], order[size:]
+            if not options.BAND_WIDTH:
+                size = len(order)
+            keep = [k for k in batch if bounds[k] > max_match[0] or
+                    (bounds[k] == max_match[0] and k > max_match[1])]
+            with self.lock:
+                self.counts['pruned'] += len(batch) - len(keep)
+            if not keep:
+                continue
+
+            for k in keep:
+                options.debug("Aligning %33s v. %33s." % (qname, sname))
+            if options.BAND_WIDTH:
+                alns = [BandedCTether(
+                    subject.seq, queries[k].seq,
+                    _offset(candidates[k], res, subj[sname].type == 'nucl'),
+                    options.BAND_WIDTH, matrix=matrix) for k in keep]
+            else:
+                alns = aligner(subject.seq, [queries[k].seq for k in keep],
+                               matrix=matrix)
+            with self.lock:
+                self.counts['aligned'] += len(keep)
+
+            for k, aln in zip(keep, alns):
+                region = candidates[k][-3 * aln['sublength']:]
+                identity = float(aln['identities']) / aln['length']
+                if identity > max_match[0] or \
+                        (identity == max_match[0] and k > max_match[1]):
+                    max_match = (identity, k, (region, sname, aln))
+
+        if not max_match[2]:
+            return None
+        seq, name, _ = max_match[2]
+        odl = subject.defline.split('[')[0].strip()
+        src = seq.original.name
+        start, end, strand = seq.start, seq.end, seq.step
+        defline = '%s[source=%s] [start=%d] [end=%d] [strand=%d]' % \
+            (odl + (' ' if odl else ''), src, start, end, strand)
+
+        return Sequence(name.strip(), seq.seq, defline=defline,
+                        original=seq.original, type=seq.type,
+                        start=seq.start, end=seq.end, step=seq.step)
+
+    def stats(self):
+        '''
+        A dictionary of counts of what this `Predictor` has done so far.
+        '''
+
+        cache = self.cache
+        return {'aligned': self.counts['aligned'],
+                'pruned': self.counts['pruned'],
+                'unresolved': self.orfs.unresolved,
+                'frame hits': self.frames.hits,
+                'frame misses': self.frames.misses,
+                'cache hits': cache.hits if cache is not None else 0,
+                'cache misses': cache.misses if cache is not None else 0}
+
+
+class JobCoalescer(object):
+    '''
+    Merges BLAST hits that would lead to the same alignments: hits of the
+    same database sequence to the same ORFs of a contig, on the same strand
+    (and, for banded alignments, lined up the same way). Only the first hit
+    of each group needs to be aligned; the gene found for it is passed to
+    `output` once for every hit in the group, including those that come in
+    after it was found. The number of hits merged is kept in `merged`.
+
+    If `scan` is false, the ORFs of the contigs aren't looked for (`orfs` is
+    then only used to resolve contig names), and hits are only merged if
+    they are of the same database sequence to the same stretch of a contig,
+    in the same frame (and, for banded alignments, from the same place in
+    the database sequence).
+    '''
+
+    def __init__(self, orfs, subj, output, scan=True):
+        self.orfs = orfs
+        self.subj = subj
+        self.output = output
+        self.scan = scan
+        self.jobs = {}
+        self.merged = 0
+        self.lock = threading.Lock()
+
+    def key(self, res):
+        '''
+        The key of the alignments that the BLAST result `res` leads to.
+        '''
+
+        sname, frame = res.subject.name, int(res.frame)
+        qname = self.orfs.resolve(res.query.name)
+        if qname is None:
+            return sname, None, 0, ()
+        if not self.scan:
+            sstart = res.subject.start if options.BAND_WIDTH else None
+            return sname, qname, frame, res.query.start, res.query.end, sstart
+        orfs = self.orfs.overlapping(qname, res.query.start, res.query.end,
+                                     frame)
+        if options.BAND_WIDTH:
+            nucl = self.subj[sname].type == 'nucl'
+            orfs = tuple((orf.start, orf.end, _offset(orf[:-3], res, nucl))
+                         for orf in orfs)
+        else:
+            orfs = tuple((orf.start, orf.end) for orf in orfs)
+        return sname, qname, frame > 0, orfs
+
+    def add(self, res):
+        '''
+        Adds a BLAST result, and gives its key if it needs to be aligned, or
+        None if it was merged into an earlier one.
+        '''
+
+        key = self.key(res)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                self.jobs[key] = [1, False, None]
+                return key
+            self.merged += 1
+            if not job[1]:
+                job[0] += 1
+                return None
+        if job[2] is not None:
+            self.output(job[2])
+        return None
+
+    def finish(self, key, gene):
+        '''
+        Records the gene found for `key` (or None) and passes it on for each
+        of the hits that are waiting for it.
+        '''
+
+        with self.lock:
+            job = self.jobs[key]
+            job[1], job[2] = True, gene
+            count = job[0]
+        if gene is not None:
+            for _ in range(count):
+                self.output(gene)
+
+
+class GeneWriter(object):
+    '''
+    Writes genes out as they are found. Each gene is appended to the FASTA
+    file `fasta`, and the distinct genes (told apart by a digest of their
+    sequences) are listed in the GFF3 file `gff`, along with the names of
+    all of the genes that had that sequence, as annotations from `source`.
+    The files are brought up to date every `batch` genes: the FASTA file is
+    flushed and the new distinct genes are appended to the GFF3 file, so if
+    a run stops partway, both hold the genes found up until then.
+
+    A gene with the same sequence as one that is already in the GFF3 file
+    only adds its name to that annotation, so if there are any, the GFF3
+    file is written anew (once) when the writer is closed.
+    '''
+
+    def __init__(self, fasta, gff, source, batch=64):
+        self.fasta = io.open(fasta, 'w')
+        self.gff = gff
+        self.gffh = io.open(gff, 'w')
+        self.source = source
+        self.batch = batch
+        self.genes = OrderedDict()
+        self.unwritten = []
+        self.stale = False
+        self.count = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def write(self, gene):
+        '''
+        Adds a gene to the output.
+        '''
+
+        digest = hashlib.sha1(gene.seq.encode('ascii')).digest()
+        with self.lock:
+            self.fasta.write(gene)
+            self.count += 1
+            options.debug("Wrote %s (%d)." % (gene.name, self.count))
+            entry = self.genes.get(digest)
+            if entry is None:
+                self.genes[digest] = [gene, [gene.name], False]
+                self.unwritten.append(digest)
+            elif gene.name not in entry[1]:
+                entry[1].append(gene.name)
+                self.stale = self.stale or entry[2]
+            self.pending += 1
+            if self.pending >= self.batch:
+                self._flush()
+
+    def _annotation(self, digest):
+        gene, names, _ = self.genes[digest]
+        return ann(gene, self.source, 'gene', homologs=','.join(names))
+
+    def _flush(self):
+        '''
+        Flushes the FASTA file and appends the genes that aren't in the GFF3
+        file yet.
+        '''
+
+        self.fasta.handle.flush()
+        for digest in self.unwritten:
+            self.gffh.write(self._annotation(digest))
+            self.genes[digest][2] = True
+        self.gffh.handle.flush()
+        self.unwritten = []
+        self.pending = 0
+
+    def flush(self):
+        '''
+        Brings the files up to date with the genes written so far.
+        '''
+
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        '''
+        Brings the files up to date and closes them. If genes were added to
+        annotations that had already been written, the GFF3 file is written
+        again and moved into place.
+        '''
+
+        with self.lock:
+            self._flush()
+            self.gffh.close()
+            self.fasta.close()
+            if self.stale:
+                part = self.gff[:self.gff.rfind('.')] + '.part.gff3'
+                gh = io.open(part, 'w')
+                for digest in self.genes:
+                    gh.write(self._annotation(digest))
+                gh.close()
+                rename(part, self.gff)
+
+
+_predictor = None
+_coalescer = None
+_genes = {}
+_reported = {}
+# only one strain at a time aligns in worker processes (see `_align_hits`).
+_pool_lock = threading.Lock()
+
+
+def _start_worker(subj, contigs):
+    '''
+    Sets up the `Predictor` of a worker process, which is then used for all
+    of the hits that the process is given, and the `JobCoalescer` whose keys
+    its genes are remembered by. The worker gets its own lock for
+    `options.debug`, since another thread may have held the parent's when
+    the worker was forked.
+    '''
+
+    global _predictor, _coalescer
+    options.lock = threading.Lock()
+    _predictor = Predictor(subj, contigs)
+    _coalescer = JobCoalescer(_predictor.orfs, subj, None)
+    if _predictor.cache is not None:
+        # run when the pool shuts the worker down.
+        Finalize(_predictor.cache, _predictor.cache.flush, exitpriority=0)
+
+
+def _work(job):
+    '''
+    Predicts the gene for one `(key, BLAST result)` job in a worker process.
+    The parent process merges hits without looking for ORFs, so the worker
+    remembers the gene it found for each set of ORFs (by the keys of a
+    `JobCoalescer`) and reuses it for hits that lead to the same alignments.
+    Since the parent process has the contigs, the gene is sent back without
+    its contig, along with the key, the counts of what was done since the
+    last job, and whether the gene was reused.
+    '''
+
+    global _reported
+    key, res = job
+    orfs = _coalescer.key(res)
+    merged = orfs in _genes
+    if merged:
+        new = _genes[orfs]
+    else:
+        new = _predictor.predict(res)
+        if new is not None:
+            new = (new.name, new.seq, new.defline, new.original.name,
+                   new.type, new.start, new.end, new.step)
+        _genes[orfs] = new
+    stats = _predictor.stats()
+    delta = dict((key, stats[key] - _reported.get(key, 0)) for key in stats)
+    _reported = stats
+    return key, new, delta, merged
+
+
+class ThreadQueue(object):
+    '''
+    Runs `target` on each item `put` into a queue, in `threads` worker
+    threads. The queue holds at most `size` items (four per thread, by
+    default) and `put` blocks while it is full, so whatever produces the
+    items can never get too far ahead of the workers. `close` lets the
+    workers finish what is in the queue, stops them, and raises the first
+    exception that any of them ran into.
+
+    Items should be put in from one thread. The number of items put in, the
+    greatest and total depth of the queue when they were, and the time each
+    worker spent busy are kept, and are summed up by `metrics`.
+    '''
 
-    def __init__(self, target):
-        queue.Queue.__init__(self)
-        self.threadcount = 0
+    def __init__(self, target, threads, size=None):
         self.target = target
+        self.queue = queue.Queue(size or 4 * threads)
+        self.puts, self.depth, self.max_depth = 0, 0, 0
+        self.busy = [0.0] * threads
+        self.error = None
+        self.started, self.elapsed = time.time(), None
+        self.threads = [threading.Thread(target=self._work, args=(i,))
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, i):
+        '''
+        Runs the target on items from the queue until it gets a sentinel.
+        After an exception, items are still taken off the queue (so that
+        `put` never blocks for good) but not worked on.
+        '''
+
+        while 1:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            if self.error is not None:
+                continue
+            start = time.time()
+            try:
+                self.target(item)
+            except Exception as e:
+                self.error = self.error or e
+            self.busy[i] += time.time() - start
 
     def put(self, item):
-        options.lock.acquire()
-        queue.Queue.put(self, item)
-        if self.threadcount < options.NUM_THREADS - 1:
-            thread = threading.Thread(target=self.target)
-            thread.start()
-            self.threadcount += 1
-        options.lock.release()
+        '''
+        Adds an item to the queue, waiting for room if it is full.
+        '''
+
+        depth = self.queue.qsize()
+        self.puts += 1
+        self.depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.queue.put(item)
+
+    def close(self):
+        '''
+        Waits for the workers to finish everything in the queue, and stops
+        them.
+        '''
+
+        for thread in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.elapsed = time.time() - self.started
+        if self.error is not None:
+            raise self.error
+
+    def metrics(self):
+        '''
+        A dictionary of the number of items put in, the greatest and average
+        depth of the queue when they were, and the fraction of the time
+        (up until `close`) that the workers were busy.
+        '''
+
+        elapsed = self.elapsed or time.time() - self.started
+        return {'items': self.puts, 'max depth': self.max_depth,
+                'mean depth': float(self.depth) / max(1, self.puts),
+                'utilization': sum(self.busy) /
+                max(1e-9, elapsed * len(self.threads))}
+
+
+def _align_processes(hits, subj, contigs, output):
+    '''
+    Does the work of `_align_hits` in `ALIGN_PROCESSES` worker processes.
+    '''
+
+    stats = {}
+    # the workers look for the ORFs, so they aren't looked for here too.
+    jobs = JobCoalescer(ORFFinder(contigs), subj, output, scan=False)
+    # the pool takes tasks as fast as they come, so they are held back
+    # until there is room for them.
+    slots = threading.Semaphore(4 * options.ALIGN_PROCESSES)
+    stopped = threading.Event()
+
+    def tasks():
+        for res in hits:
+            if stopped.is_set():
+                return
+            key = jobs.add(res)
+            if key is not None:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield key, res
+
+    pool = Pool(options.ALIGN_PROCESSES, _start_worker, (subj, contigs))
+    try:
+        for key, new, delta, merged in pool.imap_unordered(_work, tasks()):
+            if new is not None:
+                name, seq, defline, src, type, start, end, step = new
+                new = Sequence(name, seq, defline=defline,
+                               original=contigs[src], type=type,
+                               start=start, end=end, step=step)
+            slots.release()
+            if merged:
+                with jobs.lock:
+                    jobs.merged += 1
+            jobs.finish(key, new)
+            for key in delta:
+                stats[key] = stats.get(key, 0) + delta[key]
+    except BaseException as error:
+        # the pool can only shut down once the thread feeding it tasks
+        # is out of `tasks`, so it is woken up and told to stop.
+        stopped.set()
+        slots.release()
+        pool.terminate()
+        pool.join()
+        raise error
+    pool.close()
+    pool.join()
+    return stats, jobs.merged
+
+
+def _align_hits(hits, subj, contigs, output):
+    '''
+    Finds the genes for the BLAST results `hits`, in `NUM_THREADS` threads
+    or `ALIGN_PROCESSES` processes, and passes each one to `output`. Returns
+    the counts of what was done (see `Predictor.stats`) and the number of
+    hits that were merged into others.
+    '''
+
+    if options.ALIGN_PROCESSES:
+        # when several strains are predicted at once (in threads), their
+        # pools are made one at a time, rather than being forked alongside
+        # one another.
+        with _pool_lock:
+            return _align_processes(hits, subj, contigs, output)
+
+    predictor = Predictor(subj, contigs)
+    jobs = JobCoalescer(predictor.orfs, subj, output)
+
+    def target(job):
+        key, res = job
+        jobs.finish(key, predictor.predict(res))
+
+    qin = ThreadQueue(target, max(1, options.NUM_THREADS))
+    try:
+        for res in hits:
+            key = jobs.add(res)
+            if key is not None:
+                qin.put((key, res))
+    finally:
+        qin.close()
+    if predictor.cache is not None:
+        predictor.cache.flush()
+    metrics = qin.metrics()
+    options.debug("%d hits queued for alignment, at most %d waiting " %
+                  (metrics['items'], metrics['max depth']) +
+                  "(%.1f on average); workers busy %.0f%% of the time." %
+                  (metrics['mean depth'], 100 * metrics['utilization']))
+    stats = predictor.stats()
+
+    return stats, jobs.merged
 
 
 def GeneFromBLAST(db, sequences, pref, names):
@@ -73,8 +781,12 @@ def GeneFromBLAST(db, sequences, pref, names):
     that corresponds to that BLAST hit. Genes that are found are saved in the
     subdirectory sequences under the given directory, divided depending on
     whether the sequnece is amino acid or nucleotide.
+
+    The hits are aligned by `NUM_THREADS` threads, or, if `ALIGN_PROCESSES`
+    is set, by that many worker processes, each of which loads the database
+    sequences and contigs once when it starts. When several strains are
+    predicted at once, they take turns using worker processes.
     '''
-    PIPING = True
     wd = options.DIRECTORY + 'sequences' + sep
 
     for d in [options.DIRECTORY, wd]:
@@ -83,137 +795,60 @@ def GeneFromBLAST(db, sequences, pref, names):
         except OSError:
             pass
 
-    subj = dict((s.name, s) for s in io.open(db, 'r'))
+    subj = dict((s.name, s) for s in io.open(db, 'r', compact=True))
     options.debug("Database sequences loaded from file %s." % db)
 
     try:
-        orfs = dict((s.name, [orf for orf in ORFGenerator(s)])
-                    for s in io.open(sequences, 'r'))
-        options.debug("ORFs loaded from file %s." % sequences)
+        contigs = dict((s.name, pack(s)) for s in io.open(sequences, 'r'))
+        options.debug("Contigs loaded from file %s." % sequences)
     except IOError:
         options.debug("No file \"" + sequences + ",\" skipping.")
         return
 
-    def target():
-        while 1:
-            try:
-                res = qin.get(PIPING, 1)
-            except queue.Empty:
-                if not PIPING:
-                    break
-                else:
-                    continue
-
-            qname, sname = res['query']['name'], res['subject']['name']
-            start, end = res['query']['start'], res['query']['end']
-            alignments = []
-            max_match = (options.MIN_IDENTITY, None)
-
-            if subj[sname].type == 'nucl':
-                subject = translate(subj[sname])
-            else:
-                subject = subj[sname]
-
-            while qname:
-                try:
-                    o = orfs[qname]
-                    break
-                except KeyError:
-                    qname = qname[:-1]
-            if not qname:
-                qin.task_done()
-                continue
-
-            for orf in o:
-                if in_range(orf, start, end, res['frame']):
-                    orf = orf[:-3]
-                    query = translate(orf)
-                    options.debug("Aligning %33s v. %33s." % (qname, sname))
-                    alignment = align(subject.seq, query.seq)
-                    alignments.append((orf, sname, alignment))
-
-            for orf, refname, aln in alignments:
-                hitlen = aln['sublength']
-                region = orf[-3 * hitlen:]
-                identity = float(aln['identities']) / aln['length']
-                if identity >= max_match[0]:
-                    max_match = (identity, (region, sname, aln))
-
-            if max_match[1]:
-                seq, name, _ = max_match[1]
-                odl = subject.defline.split('[')[0].strip()
-                src = seq.original.name
-                start, end, strand = seq.start, seq.end, seq.step
-                defline = '%s[source=%s] [start=%d] [end=%d] [strand=%d]' % \
-                    (odl + (' ' if odl else ''), src, start, end, strand)
-
-                new = Sequence(name.strip(), seq.seq, defline=defline,
-                               original=seq.original, type=seq.type,
-                               start=seq.start, end=seq.end, step=seq.step)
-                qout.put(new)
-            qin.task_done()
-
-    def in_range(seq, start, end, frame):
-        ss, se = sorted((seq.start, seq.end))
-        os, oe = sorted((start, end))
-        frame = int(frame)
-
-        return (ss < oe and se > os and
-                (se % 3 == oe % 3 or ss % 3 == oe % 3) and
-                ((frame < 0 and seq.step < 0) or
-                 (frame > 0 and seq.step > 0)))
-
-    qout = queue.Queue()
-    qin = ThreadQueue(target)
-
-    blastopts = {
-        'evalue': options.MAX_EVALUE,
-        'num_threads': options.NUM_THREADS
-    }
-
-    for res in BLAST.run(db, sequences, **blastopts):
-        if float(res['expect']) > options.MAX_EVALUE:
-            continue
-
-        sbjl = len(subj[res['subject']['name']])
-        ident = float(res['identities'].split('(')[1][:-2]) / 100
-        lerr = float(res['subject']['length']) / sbjl
-
-        if ident >= options.MIN_IDENTITY:
+    def hits():
+        blastopts = {
+            'evalue': options.MAX_EVALUE,
+            'num_threads': options.NUM_THREADS,
+            'outfmt': options.BLAST_FORMAT,
+            'shards': options.BLAST_SHARDS,
+            'registry': BLAST.DatabaseRegistry(options.BLAST_REGISTRY)
+            if options.BLAST_REGISTRY else None,
+            'max_evalue': options.MAX_EVALUE,
+            'min_identity': options.MIN_IDENTITY
+        }
+
+        for res in BLAST.run(db, sequences, **blastopts):
+            lerr = float(res.subject.length) / len(subj[res.subject.name])
             if lerr >= (1.0 - options.LENGTH_ERR):
-                qin.put(res)
-    PIPING = False
-    options.debug("BLAST done.")
-
-    target()
-    qin.join()
-    options.debug("Done Aligning sequences.")
-
-    options.debug("Now writing sequences (%d)." % qout.qsize())
-    seqs = {}
-    nuc_file = io.open(wd + pref + '.fasta', 'w')
-    count = 0
-    while 1:
-        try:
-            seq = qout.get(False)
-            if seq.seq not in seqs:
-                seqs[seq.seq] = set()
-            seqs[seq.seq].add(seq)
-            nuc_file.write(seq)
-            count += 1
-            options.debug("Wrote %s (%d)." % (seq.name, count));
-        except queue.Empty:
-            break
-    nuc_file.close()
-    options.debug("Done Aligning sequences.")
+                yield res
+        options.debug("BLAST done.")
 
-    gh = io.open(wd + pref + '.gff3', 'w')
+    writer = GeneWriter(wd + pref + '.fasta', wd + pref + '.gff3', pref)
+    try:
+        stats, merged = _align_hits(hits(), subj, contigs, writer.write)
+    finally:
+        writer.close()
     names.append(wd + pref + '.fasta')
 
-    for id in seqs:
-        gh.write(ann(seqs[id].copy().pop(), pref, 'gene',
-                     homologs=','.join(s.name for s in seqs[id])))
-    gh.close()
+    options.debug("Done Aligning sequences.")
+    options.debug("Translation cache: %d hits, %d misses." %
+                  (stats['frame hits'], stats['frame misses']))
+    if options.ALIGNMENT_CACHE:
+        lookups = max(1, stats['cache hits'] + stats['cache misses'])
+        options.debug("Alignment cache: %d hits, %d misses (%.1f%%)." %
+                      (stats['cache hits'], stats['cache misses'],
+                       100.0 * stats['cache hits'] / lookups))
+    options.debug("%d ORFs aligned, %d skipped as they could not have " %
+                  (stats['aligned'], stats['pruned']) +
+                  "been the best match.")
+    options.debug("%d BLAST hits merged into the alignments of others." %
+                  merged)
+    if stats['unresolved']:
+        options.debug("%d query names did not match any contig." %
+                      stats['unresolved'])
+
+    options.debug("Wrote %d genes (%d distinct)." %
+                  (writer.count, len(writer.genes)))
 
 
 def run(subject, query, prefix, names):
@@ -58,7 +58,8 @@ def var(files):
             type = set(['prot'])
         fid = (type.pop(), f)
         seqs = [''.join(s.seq.split('-')).strip() for s in seqs]
-        seqs = [translate(s) if fid[0] == 'nucl' else s for s in seqs]
+        seqs = [translate(s, options.GENETIC_CODE) if fid[0] == 'nucl'
+                else s for s in seqs]
         sset = frozenset(seqs)
         srtr = (len(seqs), sset)
         sort[srtr] = sort.get(srtr, set()) | set([fid])
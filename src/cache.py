@@ -0,0 +1,198 @@
+'''
+An on-disk cache of alignments. Aligning the same reference to the same
+translation always gives the same result, so when the same references are
+aligned to overlapping sets of genomes again and again, most alignments can
+be looked up rather than done. Results are kept in an SQLite database, keyed
+by a digest of everything that goes into an alignment: the two sequences,
+the gap penalties, the scoring matrix, and the `START_CODONS`,
+`GENETIC_CODE` and `LENGTH_ERR` options. The least recently used
+results are thrown out once there are more than a given number of them.
+
+SQLite does its own locking, so any number of threads and processes can
+share one cache file.
+'''
+
+import biotools.align as align
+import biotools.analysis.options as options
+from threading import Lock, local
+import hashlib
+import sqlite3
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def _string(seq):
+    '''
+    The string of a `Sequence`, or the string itself.
+    '''
+
+    try:
+        return seq.seq
+    except AttributeError:
+        return seq
+
+
+def _fingerprint(matrix):
+    '''
+    A digest of the letters and scores of a `ScoringMatrix`.
+    '''
+
+    digest = hashlib.sha1(matrix.alphabet.encode('ascii'))
+    digest.update(matrix.scores.tostring())
+    digest.update(matrix.codes.tostring())
+    return digest.hexdigest()
+
+
+class AlignmentCache(object):
+    '''
+    Keeps up to about `size` alignment results in the SQLite database
+    `filename`, which is made if it doesn't exist. Its `OptimalCTether` and
+    `align_many` methods give the same results as those in `biotools.align`,
+    but only align what they can't find in the cache. The number of cache
+    `hits` and `misses` are kept.
+
+    So that looking results up never has to write to the database, the
+    times they were last used at are kept in memory and written in batches
+    (see `flush`).
+    '''
+
+    def __init__(self, filename, size=100000):
+        self.filename = filename
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.used = {}
+        self.lock = Lock()
+        self.local = local()
+        self.matrices = {}
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS alignments ' +
+                       '(key TEXT PRIMARY KEY, result BLOB, used REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS alignments_used ' +
+                       'ON alignments (used)')
+
+    def _connection(self):
+        '''
+        This thread's connection to the database; SQLite connections can't
+        be shared between threads.
+        '''
+
+        try:
+            return self.local.db
+        except AttributeError:
+            db = sqlite3.connect(self.filename, timeout=60)
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+            self.local.db = db
+            return db
+
+    def key(self, reference, translation, extend=1, create=10, matrix=None):
+        '''
+        The key of the alignment of `reference` and `translation` with the
+        given parameters, as `OptimalCTether` would do it right now.
+        '''
+
+        matrix = matrix or align.BLOSUM62
+        with self.lock:
+            entry = self.matrices.get(id(matrix))
+            if entry is None or entry[0] is not matrix:
+                entry = self.matrices[id(matrix)] = \
+                    (matrix, _fingerprint(matrix))
+        fields = (_string(reference), _string(translation), str(extend),
+                  str(create), ','.join(sorted(options.START_CODONS)),
+                  str(options.GENETIC_CODE), repr(options.LENGTH_ERR),
+                  entry[1])
+        return hashlib.sha1('\0'.join(fields).encode('ascii')).hexdigest()
+
+    def get(self, key):
+        '''
+        The result stored under `key`, or `None` if there isn't one.
+        '''
+
+        row = self._connection().execute(
+            'SELECT result FROM alignments WHERE key = ?', (key,)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used[key] = time.time()
+            full = len(self.used) >= 256
+        if full:
+            self.flush()
+        return pickle.loads(bytes(row[0]))
+
+    def flush(self):
+        '''
+        Writes the times that results were last used at, since the last
+        flush, to the database in one transaction. This is done every so
+        often by `get` and before results are thrown out by `put`, and
+        should be done once the cache is no longer needed.
+        '''
+
+        with self.lock:
+            used, self.used = self.used, {}
+        if used:
+            with self._connection() as db:
+                db.executemany('UPDATE alignments SET used = ? WHERE key = ?',
+                               [(used[key], key) for key in used])
+
+    def put(self, key, result):
+        '''
+        Stores `result` under `key`. Every so often, the least recently used
+        results past the first `size` are thrown out.
+        '''
+
+        blob = sqlite3.Binary(pickle.dumps(result, 2))
+        with self.lock:
+            self.puts += 1
+            evict = self.puts % max(1, self.size // 64) == 0
+        if evict:
+            self.flush()
+        with self._connection() as db:
+            db.execute('INSERT OR REPLACE INTO alignments VALUES (?, ?, ?)',
+                       (key, blob, time.time()))
+            if evict:
+                db.execute('DELETE FROM alignments WHERE key IN (SELECT ' +
+                           'key FROM alignments ORDER BY used DESC ' +
+                           'LIMIT -1 OFFSET ?)', (self.size,))
+
+    def OptimalCTether(self, reference, translation, extend=1, create=10,
+                       compact=None, matrix=None):
+        '''
+        The same as `biotools.align.OptimalCTether`, looked up in the cache
+        if it can be.
+        '''
+
+        return self.align_many(reference, [translation], extend, create,
+                               compact, matrix)[0]
+
+    def align_many(self, reference, translations, extend=1, create=10,
+                   compact=None, matrix=None):
+        '''
+        The same as `biotools.align.align_many`; only the translations whose
+        alignments aren't in the cache are aligned.
+        '''
+
+        keys = [self.key(reference, translation, extend, create, matrix)
+                for translation in translations]
+        results = [self.get(key) for key in keys]
+        missing = [k for k, result in enumerate(results) if result is None]
+        if missing:
+            found = align.align_many(reference,
+                                     [translations[k] for k in missing],
+                                     extend, create, compact, matrix)
+            for k, result in zip(missing, found):
+                self.put(keys[k], result)
+                results[k] = result
+        return results
+
+    def __len__(self):
+        with self._connection() as db:
+            return db.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
@@ -1,40 +1,66 @@
 #!/usr/bin/env python
-from biotools.sequence import isprot
+from biotools.packed import PackedSequence, _notnucl
 
+_bases = 'ACGTURYKMSWBDHVN'
 _ref = {
-    'DNA': {
-        'A': 'T', 'T': 'A', 'a': 't', 't': 'a', 
-        'C': 'G', 'G': 'C', 'c': 'g', 'g': 'c',
-        'R': 'Y', 'Y': 'R', 'r': 'y', 'y': 'r',
-        ' ': ' ', '-': '-'
-    },
-    'RNA': {
-        'A': 'U', 'U': 'A', 'a': 'u', 'u': 'a',
-        'C': 'G', 'G': 'C', 'c': 'g', 'g': 'c',
-        'R': 'Y', 'Y': 'R', 'r': 'y', 'y': 'r',
-        ' ': ' ', '-': '-'
-    }
+    'DNA': 'TGCAAYRMKSWVHDBN',
+    'RNA': 'UGCAAYRMKSWVHDBN'
 }
 
 
+def _table(repl):
+    '''
+    Builds a translation table that complements every IUPAC code, in upper
+    or lower case, leaves gaps and spaces alone and turns everything else
+    into an N.
+    '''
+
+    table = ['N'] * 256
+    for b, c in zip(_bases, repl):
+        table[ord(b)], table[ord(b.lower())] = c, c.lower()
+    table[ord(' ')], table[ord('-')] = ' ', '-'
+    return ''.join(table)
+
+_tables = dict((kind, _table(_ref[kind])) for kind in _ref)
+
+
+def _complement(value):
+    '''
+    Complements a string in a single call to `str.translate`. Returns None
+    if the string is not a nucleotide sequence. Unicode strings are
+    complemented as byte strings and given back as unicode.
+    '''
+
+    if _notnucl.search(value):
+        return None
+    if ('T' in value or 't' in value) or not ('U' in value or 'u' in value):
+        table = _tables['DNA']
+    else:
+        table = _tables['RNA']
+    if isinstance(value, bytes):
+        return value.translate(table)
+    return value.encode('ascii').translate(table).decode('ascii')
+
+
 def complement(s):
     '''
     Creates the complement of a sequence, which can then be reversed by using
     `seq[::-1]`, if it needs to be reversed. This function accepts either
-    `Sequence`s or strings.
+    `Sequence`s or strings. All of the IUPAC nucleotide codes are understood;
+    protein sequences (`Sequence`s whose `type` is `'prot'`, or strings with
+    other letters in them) are returned unchanged.
     '''
 
-    if isprot(s):
+    if isinstance(s, PackedSequence):
+        return s.complement()
+    if getattr(s, 'type', None) == 'prot':
+        return s
+    try:
+        value = _complement(s.seq)
+    except AttributeError:
+        value = _complement(s)
+    if value is None:
         return s
-    has_u = ('U' in s or 'u' in s)
-    has_t = ('T' in s or 't' in s)
-    if has_u and not has_t:
-        repl = _ref['RNA']
-    elif has_t and not has_u:
-        repl = _ref['DNA']
-    else:
-        repl = _ref['DNA']
-    value = ''.join(repl.get(c, 'N') for c in s)
     try:
         return s.__class__("complement(%s)" % s.name, value,
                            original=s.original, start=s.start,
@@ -43,7 +69,58 @@ def complement(s):
         return s.__class__(value)
 
 
+def revcomp(s):
+    '''
+    Creates the reverse complement of a sequence. This gives the same result
+    as `complement(seq[::-1])`, but reverses and complements the string in
+    one go. This function accepts either `Sequence`s or strings.
+    '''
+
+    if isinstance(s, PackedSequence):
+        return s.reverse_complement()
+    if getattr(s, 'type', None) == 'prot':
+        return s[::-1]
+    try:
+        value = _complement(s.seq)
+    except AttributeError:
+        value = _complement(s)
+        return s[::-1] if value is None else s.__class__(value[::-1])
+    rev = s[::-1]
+    if value is None:
+        return rev
+    return rev.__class__("complement(%s)" % rev.name, value[::-1],
+                         original=rev.original, start=rev.start,
+                         end=rev.end, step=rev.step, qual=rev.qual)
+
+
+def complement_many(seqs):
+    '''
+    Complements each of the `Sequence`s (or strings) in an iterable, keeping
+    the name, position and strand of each one. This is a generator.
+    '''
+
+    for s in seqs:
+        yield complement(s)
+
+
+def revcomp_many(seqs):
+    '''
+    Reverse complements each of the `Sequence`s (or strings) in an iterable,
+    keeping the name, position and strand of each one. This is a generator.
+    '''
+
+    for s in seqs:
+        yield revcomp(s)
+
+
 if __name__ == '__main__':
+    from biotools.sequence import Sequence
     assert complement('ATCGTAGCTGATCGAT') == 'TAGCATCGACTAGCTA'
     assert complement('AUCGUAGCUGAUCGAU') == 'UAGCAUCGACUAGCUA'
+    assert complement('ACGTRYKMSWBDHVN') == 'TGCAYRMKSWVHDBN'
+    assert revcomp('AACGTT-N') == 'N-AACGTT'
+    s = Sequence('x', 'ACGTKMACGT')
+    assert complement(s).seq == 'TGCAMKTGCA'
+    assert revcomp(s).seq == 'ACGTKMACGT'
+    assert revcomp(Sequence('x', 'VMK', type='prot')).seq == 'KMV'
     print(complement('AUCgu--cuGAUCGAU'))
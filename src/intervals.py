@@ -0,0 +1,128 @@
+'''
+A static index of intervals for answering overlap queries. The intervals are
+sorted by their start and laid out as an implicit binary search tree over
+that sorted list, where each node also knows the greatest end in its
+subtree. Finding the `k` intervals that overlap a query takes `O(log n + k)`
+time, and the whole index is just four lists.
+
+Intervals are half-open, `[start, end)`, so for 1-based, inclusive
+coordinates (like those in a GFF file) use `(start, end + 1)`.
+'''
+
+
+class IntervalIndex(object):
+    '''
+    An index of `(start, end, value)` triples that can quickly find all of
+    the values whose intervals overlap a given interval. The index can not
+    be changed once it is built.
+    '''
+
+    def __init__(self, intervals=()):
+        '''
+        Builds the index from an iterable of `(start, end, value)` triples.
+        '''
+
+        intervals = sorted(intervals, key=lambda i: (i[0], i[1]))
+        self.starts = [i[0] for i in intervals]
+        self.ends = [i[1] for i in intervals]
+        self.values = [i[2] for i in intervals]
+        self.maxes = list(self.ends)
+        self.depth = self._augment()
+
+    def _augment(self):
+        '''
+        Fills in the greatest end of each subtree of the implicit tree and
+        returns the level of its root. The node at index `i` is at level `k`
+        if the lowest `k` bits of `i` are all set, and its children are at
+        `i - 2 ** (k - 1)` and `i + 2 ** (k - 1)`.
+        '''
+
+        n = len(self.starts)
+        if not n:
+            return -1
+        maxes = self.maxes
+        last = (n - 1) & ~1
+        lastmax = maxes[last]
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in xrange(2 * x - 1, n, 4 * x):
+                right = maxes[i + x] if i + x < n else lastmax
+                maxes[i] = max(maxes[i], maxes[i - x], right)
+            last = last - x if (last >> k) & 1 else last + x
+            if last < n:
+                lastmax = max(lastmax, maxes[last])
+            k += 1
+        return k - 1
+
+    def overlapping(self, start, end):
+        '''
+        Yields the values of the intervals that overlap `[start, end)`, in
+        order of their starts.
+        '''
+
+        starts, ends, maxes = self.starts, self.ends, self.maxes
+        n = len(starts)
+        if n < 16:
+            for i in xrange(n):
+                if starts[i] >= end:
+                    break
+                if start < ends[i]:
+                    yield self.values[i]
+            raise StopIteration()
+
+        stack = [(self.depth, (1 << self.depth) - 1, False)]
+        while stack:
+            k, x, left = stack.pop()
+            if k <= 3:
+                # small subtrees are scanned from left to right.
+                first = x >> k << k
+                for i in xrange(first, min(first + (1 << (k + 1)) - 1, n)):
+                    if starts[i] >= end:
+                        break
+                    if start < ends[i]:
+                        yield self.values[i]
+            elif not left:
+                stack.append((k, x, True))
+                y = x - (1 << (k - 1))
+                if y >= n or maxes[y] > start:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] < end:
+                if start < ends[x]:
+                    yield self.values[x]
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        raise StopIteration()
+
+    def containing(self, position):
+        '''
+        Yields the values of the intervals that contain `position`.
+        '''
+
+        return self.overlapping(position, position + 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for start, end, value in zip(self.starts, self.ends, self.values):
+            yield start, end, value
+        raise StopIteration()
+
+
+if __name__ == '__main__':
+    import random
+    random.seed(0)
+    for n in (0, 1, 5, 15, 16, 17, 100, 1000):
+        spans = [(s, s + random.randint(0, 50), k) for k, s in
+                 enumerate(random.randint(0, 1000) for _ in range(n))]
+        index = IntervalIndex(spans)
+        assert len(index) == n and sorted(index) == sorted(spans)
+        for _ in range(200):
+            a = random.randint(-10, 1060)
+            b = a + random.randint(1, 80)
+            found = list(index.overlapping(a, b))
+            assert found == [k for s, e, k in sorted(spans)
+                             if s < b and a < e]
+            assert list(index.containing(a)) == \
+                list(index.overlapping(a, a + 1))
+    print(list(IntervalIndex([(1, 5, 'a'), (4, 9, 'b')]).containing(4)))
@@ -0,0 +1,125 @@
+'''
+Substitution matrices for scoring alignments. A `ScoringMatrix` keeps its
+scores in a dense NumPy array along with a table that turns the bytes of a
+sequence into row and column indices, so that aligners can score whole
+sequences (or whole rows of a dynamic programming matrix) at once instead of
+looking up one pair of residues at a time. Matrices can be read from files
+in the format NCBI uses for BLOSUM, PAM and nucleotide matrices (e.g.,
+`BLOSUM62` or `NUC.4.4`).
+'''
+
+import numpy as np
+
+
+class ScoringMatrix(object):
+    '''
+    A substitution matrix over the residues in `alphabet`, where
+    `scores[i][j]` is the score for aligning `alphabet[i]` with
+    `alphabet[j]`. Lower case letters are scored as their upper case
+    counterparts, unless they are in the alphabet themselves, and anything
+    else is scored as `default` (X for proteins, N for nucleotides, if the
+    matrix has them). If there is no such letter, anything else scores 0
+    against everything; the `scores` then have an extra row and column for
+    it.
+    '''
+
+    def __init__(self, alphabet, scores, default=None):
+        self.alphabet = alphabet
+        self.scores = np.array(scores, dtype=np.int64)
+        if self.scores.shape != (len(alphabet), len(alphabet)):
+            raise ValueError("Matrix must have one row and column per " +
+                             "letter of the alphabet.")
+        if default is None:
+            default = 'X' if 'X' in alphabet else \
+                'N' if 'N' in alphabet else None
+        self.default = default
+        self.codes = np.empty(256, dtype=np.intp)
+        if default is None:
+            self.scores = np.pad(self.scores, ((0, 1), (0, 1)), 'constant')
+            self.codes.fill(len(alphabet))
+        else:
+            self.codes.fill(alphabet.index(default))
+        for i, c in enumerate(alphabet):
+            if c.lower() not in alphabet:
+                self.codes[ord(c.lower())] = i
+        for i, c in enumerate(alphabet):
+            self.codes[ord(c)] = i
+
+    def encode(self, seq):
+        '''
+        The indices of the residues of a sequence (a string or `Sequence`)
+        into the rows and columns of `scores`.
+        '''
+
+        try:
+            seq = seq.seq
+        except AttributeError:
+            pass
+        if not isinstance(seq, bytes):
+            seq = seq.encode('ascii', 'replace')
+        return self.codes[np.frombuffer(seq, dtype=np.uint8)]
+
+    def profile(self, seq):
+        '''
+        The query profile of a sequence: an array with one row for each
+        letter of the alphabet, giving the score of that letter against each
+        residue of the sequence.
+        '''
+
+        return self.scores[:, self.encode(seq)]
+
+    def score(self, a, b):
+        '''
+        The score for aligning residue `a` with residue `b`.
+        '''
+
+        return int(self.scores[self.codes[ord(a)], self.codes[ord(b)]])
+
+    def __getitem__(self, key):
+        return self.score(*key)
+
+    def __len__(self):
+        return len(self.scores)
+
+
+def from_dict(scores, default=None):
+    '''
+    Makes a `ScoringMatrix` from a dictionary of dictionaries of scores, like
+    `biotools.align.bl`.
+    '''
+
+    alphabet = ''.join(sorted(scores))
+    return ScoringMatrix(alphabet, [[scores[a][b] for b in alphabet]
+                                    for a in alphabet], default)
+
+
+def parse(lines, default=None):
+    '''
+    Makes a `ScoringMatrix` from the lines of an NCBI-format matrix file:
+    comments start with `#`, the first other line lists the letters of the
+    columns, and each of the rest is a letter followed by its scores.
+    '''
+
+    columns, rows = None, {}
+    for line in lines:
+        line = line.split('#')[0].split()
+        if not line:
+            continue
+        if columns is None:
+            columns = ''.join(line)
+        else:
+            rows[line[0]] = [int(x) for x in line[1:]]
+
+    if columns is None or sorted(rows) != sorted(columns) or \
+            any(len(rows[c]) != len(columns) for c in rows):
+        raise ValueError("Not a valid substitution matrix.")
+    return ScoringMatrix(columns, [rows[c] for c in columns], default)
+
+
+def read(filename, default=None):
+    '''
+    Reads a `ScoringMatrix` from an NCBI-format matrix file.
+    '''
+
+    with open(filename, 'r') as fh:
+        return parse(fh, default)
@@ -0,0 +1,258 @@
+'''
+Compact storage for nucleotide sequences. Each base is packed into two bits,
+four bases to a byte, and the few characters that are not one of the four
+bases (N, or any of the other IUPAC codes) are kept on the side as a list of
+runs. Slicing, complementing and reversing all work directly on the packed
+bytes (and `biotools.translate` translates straight from the two-bit codes),
+so whole genomes (and their reverse complements) can be kept in memory at
+about a quarter of the cost of a string.
+'''
+
+from biotools.sequence import Sequence
+from array import array
+import numpy as np
+import re
+
+_iupac = {
+    'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'U': 'A',
+    'R': 'Y', 'Y': 'R', 'K': 'M', 'M': 'K', 'S': 'S', 'W': 'W',
+    'B': 'V', 'V': 'B', 'D': 'H', 'H': 'D', 'N': 'N',
+    '-': '-', ' ': ' '
+}
+_notnucl = re.compile('[^ACGTURYKMSWBDHVNacgturykmswbdhvn -]')
+_alphabets = {False: 'ACGT', True: 'ACGU'}
+_others = {False: re.compile(r'([^ACGT])\1*', re.S),
+           True: re.compile(r'([^ACGU])\1*', re.S)}
+
+_encode = np.zeros(256, dtype=np.uint8)
+for _i, _c in enumerate('ACGT'):
+    _encode[ord(_c)] = _i
+_encode[ord('U')] = 3
+
+_decode = dict((rna, np.frombuffer(_alphabets[rna].encode('ascii'),
+                                   dtype=np.uint8))
+               for rna in _alphabets)
+
+_shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+_rev = np.array([sum(((b >> s) & 3) << (6 - s) for s in (6, 4, 2, 0))
+                 for b in range(256)], dtype=np.uint8)
+_revcomp = _rev ^ 0xff
+
+
+def _unpack(words, start, length):
+    '''
+    The two-bit codes of `length` bases starting at base `start`.
+    '''
+
+    first = start // 4
+    chunk = words[first:first + (start % 4 + length + 3) // 4]
+    codes = ((chunk[:, None] >> _shifts) & 3).ravel()
+    return codes[start % 4:start % 4 + length]
+
+
+def _pack(codes):
+    '''
+    Packs an array of two-bit codes, four to a byte, first base in the high
+    bits. The last byte is padded with zeros.
+    '''
+
+    pad = -len(codes) % 4
+    if pad:
+        codes = np.concatenate((codes, np.zeros(pad, dtype=np.uint8)))
+    codes = codes.reshape(-1, 4)
+    return (codes[:, 0] << 6 | codes[:, 1] << 4 |
+            codes[:, 2] << 2 | codes[:, 3]).astype(np.uint8)
+
+
+def _shift(words, start, length):
+    '''
+    The packed bytes of `length` bases starting at base `start`, computed by
+    shifting the packed bytes rather than unpacking them.
+    '''
+
+    first, r = divmod(start, 4)
+    count = (length + 3) // 4
+    chunk = np.zeros(count + 1, dtype=np.uint8)
+    part = words[first:first + count + 1]
+    chunk[:len(part)] = part
+    if r:
+        out = (chunk[:-1] << 2 * r) | (chunk[1:] >> (8 - 2 * r))
+    else:
+        out = chunk[:-1].copy()
+    if length % 4:
+        out[-1] &= (0xff << 2 * (4 - length % 4)) & 0xff
+    return out
+
+
+class PackedSequence(Sequence):
+    '''
+    A nucleotide `Sequence` stored with two bits per base. Positions that are
+    not A, C, G, or T (or U, for RNA) are stored as runs in `exceptions`, a
+    list of `(start, end, character)` tuples. Packed sequences are always
+    upper case.
+
+    The `seq` attribute is built from the packed bytes each time it is used,
+    so it is best to hold on to it rather than asking for it repeatedly.
+    '''
+    __slots__ = ('name', 'words', 'length', 'exceptions', 'rna', 'qual',
+                 'start', 'end', 'step', 'original', 'defline')
+    type = 'nucl'
+
+    def __init__(self, name, seq, **kwargs):
+        '''
+        Takes the same parameters as the `Sequence` constructor; `seq` must
+        be a nucleotide sequence.
+        '''
+
+        seq = seq.upper()
+        self.rna = 'U' in seq and 'T' not in seq
+        self.length = len(seq)
+        self.words = _pack(_encode[np.frombuffer(seq.encode('ascii'),
+                                                 dtype=np.uint8)])
+        self.exceptions = [(m.start(), m.end(), m.group(1))
+                           for m in _others[self.rna].finditer(seq)]
+        self.name = name
+        self.qual = kwargs.get('qual', None)
+        if self.qual is not None:
+            self.qual = array('B', self.qual)
+        self.start = kwargs.get('start', 1)
+        self.end = kwargs.get('end', self.start - 1 + len(seq))
+        self.step = kwargs.get('step', -1 if self.start > self.end else 1)
+        self.original = kwargs.get('original', self)
+        self.defline = kwargs.get('defline', '')
+
+    @property
+    def seq(self):
+        codes = self.codes()
+        seq = bytearray(_decode[self.rna][codes].tostring())
+        for start, end, c in self.exceptions:
+            seq[start:end] = c * (end - start)
+        return str(seq)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        '''
+        Forward and reverse slices (steps of 1 and -1) of a packed sequence
+        are themselves packed sequences, made by shifting the packed bytes.
+        Any other step gives an ordinary `Sequence` view.
+        '''
+
+        start, stop, step = self._indices(key)
+        if step not in (1, -1):
+            return Sequence.__getitem__(self, key)
+
+        length = len(xrange(start, stop, step))
+        first = start if step == 1 else start - length + 1
+        words = _shift(self.words, first, length)
+        exceptions = [(max(s, first) - first, min(e, first + length) - first,
+                       c) for s, e, c in self.exceptions
+                      if s < first + length and e > first]
+        qual = self.qual and self.qual[first:first + length]
+        sub = self._derive(words, length, exceptions, qual)
+        if step == -1:
+            sub._reverse(_rev)
+        for attr, value in self._subinfo(start, stop, step).items():
+            setattr(sub, attr, value)
+        return sub
+
+    def _derive(self, words, length, exceptions, qual):
+        '''
+        A new packed sequence with the same metadata as this one.
+        '''
+
+        new = PackedSequence.__new__(PackedSequence)
+        new.words, new.length = words, length
+        new.exceptions, new.qual, new.rna = exceptions, qual, self.rna
+        new.name, new.defline = self.name, self.defline
+        new.start, new.end, new.step = self.start, self.end, self.step
+        new.original = self.original
+        return new
+
+    def _reverse(self, table):
+        '''
+        Reverses the sequence in place, mapping each packed byte through
+        `table` on the way.
+        '''
+
+        pad = -self.length % 4
+        self.words = _shift(table[self.words][::-1], pad, self.length)
+        self.exceptions = [(self.length - e, self.length - s, c)
+                           for s, e, c in reversed(self.exceptions)]
+        if self.qual:
+            self.qual = self.qual[::-1]
+
+    def complement(self):
+        '''
+        The complement of this sequence, as a `PackedSequence`.
+        '''
+
+        words = self.words ^ 0xff
+        if self.length % 4:
+            words[-1] &= (0xff << 2 * (4 - self.length % 4)) & 0xff
+        exceptions = [(s, e, _iupac.get(c, 'N')) for s, e, c in
+                      self.exceptions]
+        new = self._derive(words, self.length, exceptions, self.qual)
+        new.name = "complement(%s)" % self.name
+        return new
+
+    def reverse_complement(self):
+        '''
+        The reverse complement of this sequence, as a `PackedSequence`. This
+        is the same as `complement(seq[::-1])`, but in a single pass.
+        '''
+
+        new = self._derive(self.words, self.length, self.exceptions,
+                           self.qual)
+        new._reverse(_revcomp)
+        new.exceptions = [(s, e, _iupac.get(c, 'N')) for s, e, c in
+                          new.exceptions]
+        for attr, value in self._subinfo(self.length - 1, -1, -1).items():
+            setattr(new, attr, value)
+        new.name = "complement(%s)" % new.name
+        return new
+
+    def codes(self):
+        '''
+        The sequence as an array of two-bit codes, 0 through 3 for A, C, G,
+        and T (or U). Positions listed in `exceptions` are given as 0.
+        '''
+
+        return _unpack(self.words, 0, self.length)
+
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr in state:
+            setattr(self, attr, state[attr])
+
+
+def pack(seq):
+    '''
+    Returns a `PackedSequence` copy of a nucleotide `Sequence` (one made up
+    of IUPAC nucleotide codes). Protein sequences, and anything that is not
+    a `Sequence`, are returned as-is.
+    '''
+
+    if not isinstance(seq, Sequence) or isinstance(seq, PackedSequence) or \
+            _notnucl.search(seq.seq):
+        return seq
+    kwargs = {'qual': seq.qual, 'original': seq.original,
+              'start': seq.start, 'end': seq.end, 'step': seq.step,
+              'defline': seq.defline}
+    if seq.original is seq:
+        del kwargs['original']
+    return PackedSequence(seq.name, seq.seq, **kwargs)
+
+
+if __name__ == '__main__':
+    s = pack(Sequence('x', 'ACGTKMACGTNNSWA'))
+    assert isinstance(s, PackedSequence)
+    assert s.seq == 'ACGTKMACGTNNSWA'
+    assert s.reverse_complement().seq == 'TWSNNACGTKMACGT'
+    assert s[2:7].seq == 'GTKMA' and s[6:1:-1].seq == 'AMKTG'
+    p = Sequence('x', 'MEEPQSDPSV')
+    assert pack(p) is p
+    print(s.complement().seq)
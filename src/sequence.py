@@ -1,4 +1,7 @@
 from biotools.annotation import Annotation
+from array import array
+from sys import getsizeof
+from gc import get_referents
 
 
 def chop(seq, length=70):
@@ -16,9 +19,11 @@ def chop(seq, length=70):
     raise StopIteration()
 
 
-def isprot(seq, nucleotides='ATUCGNYRatucgnyr- '):
+def isprot(seq, nucleotides='ACGTURYKMSWBDHVNacgturykmswbdhvn- '):
     '''
     Check whether the current sequence is a protein or nucleotide sequence.
+    Any of the IUPAC nucleotide codes, in upper or lower case, count as
+    nucleotides.
     '''
 
     for c in seq:
@@ -32,6 +37,7 @@ class Sequence(object):
     '''
     A wrapper class for sequences.
     '''
+    _view = None
 
     def __init__(self, name, seq, **kwargs):
         '''
@@ -68,8 +74,23 @@ class Sequence(object):
         self.defline = kwargs.get('defline', '')
 
     def __getattr__(self, attr):
+        if attr in ('seq', 'qual'):
+            # subsequences are views of their parent's data and are only
+            # materialized (with native slicing) when first asked for.
+            if self._view is not None:
+                parent, start, stop, step = self._view
+                data = getattr(parent, attr)
+                if data and len(xrange(start, stop, step)):
+                    data = data[start:stop if stop >= 0 else None:step]
+                elif data:
+                    data = data[:0]
+                setattr(self, attr, data)
+                return data
         if attr == 'type':
-            self.type = 'prot' if isprot(self.seq) else 'nucl'
+            if self._view is not None:
+                self.type = self._view[0].type
+            else:
+                self.type = 'prot' if isprot(self.seq) else 'nucl'
             return self.type
         raise AttributeError('%r object has no attribute %r' % 
                              (self.__class__.__name__, attr))
@@ -83,24 +104,55 @@ class Sequence(object):
         subsequence. It also tries to fill in the annotations, but annotations
         are handled pretty poorly right now, so it's probably best not to
         worry about those, but it will work if you really want to.
+
+        The subsequence is a view: it only records its parent and the slice
+        and the sequence and quality scores are copied out of the parent the
+        first time they are used.
+        '''
+
+        start, stop, step = self._indices(key)
+        if self._view is not None:
+            parent, pstart, _, pstep = self._view
+            view = (parent, pstart + start * pstep, pstart + stop * pstep,
+                    step * pstep)
+        else:
+            view = (self, start, stop, step)
+
+        sub = Sequence.__new__(Sequence)
+        sub.__dict__.update(self._subinfo(start, stop, step), _view=view)
+        return sub
+
+    def _indices(self, key):
+        '''
+        Turns an index or a slice into a (start, stop, step) triple.
         '''
 
         try:
-            start, stop, step = key.indices(len(self.seq))
+            return key.indices(len(self))
         except AttributeError:
-            start, stop, step = key, key + 1, 1
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('sequence index out of range')
+            return key, key + 1, 1
+
+    def _subinfo(self, start, stop, step):
+        '''
+        The name, position, and ancestry of the subsequence
+        `self[start:stop:step]`.
+        '''
 
         order = abs(self.step) / self.step
         r = stop - (stop - start) % step - step
-        seq = ''.join(self.seq[x] for x in xrange(start, stop, step))
-        qual = self.qual and [self.qual[x] for x in xrange(start, stop, step)]
         info = (self.name, start, stop, step)
-        self.type
-        return Sequence("subsequence(%s, %d, %d, %d)" % info, seq,
-                        qual=qual, original=self.original, type=self.type,
-                        start=self.start + start * order,
-                        end=self.start + r * order,
-                        step=step * self.step)
+        return {
+            'name': "subsequence(%s, %d, %d, %d)" % info,
+            'original': self.original,
+            'defline': '',
+            'start': self.start + start * order,
+            'end': self.start + r * order,
+            'step': step * self.step
+        }
 
     '''
     Some other things you can do with a Sequence object:
@@ -135,7 +187,10 @@ class Sequence(object):
         raise StopIteration()
 
     def __len__(self):
-        return len(self.seq)
+        if self._view is None:
+            return len(self.seq)
+        _, start, stop, step = self._view
+        return len(xrange(start, stop, step))
 
     def __hash__(self):
         return hash(self.seq)
@@ -156,6 +211,84 @@ class Sequence(object):
                                    '\n'.join(chop(self.seq, 70)))
 
 
+class CompactSequence(Sequence):
+    '''
+    A `Sequence` that keeps its attributes in `__slots__`, its bases as
+    `bytes` and its quality scores as an `array('B')`. Since `Sequence`
+    itself isn't slotted, instances can still have a dictionary, but one
+    is only made if something else is set on them (or their `__dict__`
+    is looked at).
+    It has the same attributes and behaves the same way as a `Sequence`, but
+    uses considerably less memory when many sequences are kept around at
+    once (e.g., all of the reads of a FASTQ file or all the sequences in a
+    database). Slices of a `CompactSequence` are ordinary `Sequence` views.
+    '''
+    __slots__ = ('name', 'seq', 'qual', 'start', 'end', 'step', 'original',
+                 'defline', 'type')
+
+    def __init__(self, name, seq, **kwargs):
+        '''
+        Takes the same parameters as the `Sequence` constructor.
+        '''
+
+        if not isinstance(seq, bytes):
+            seq = seq.encode('ascii')
+        Sequence.__init__(self, name, seq, **kwargs)
+        if self.qual is not None:
+            self.qual = array('B', self.qual)
+
+    def __getstate__(self):
+        state = {}
+        for attr in self.__slots__:
+            try:
+                state[attr] = object.__getattribute__(self, attr)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for attr in state:
+            setattr(self, attr, state[attr])
+
+
+def compact(seq):
+    '''
+    Returns a `CompactSequence` copy of the given `Sequence`. Anything else
+    (e.g., an `Annotation`, or a sequence that is already compact) is
+    returned as-is.
+    '''
+
+    if not isinstance(seq, Sequence) or isinstance(seq, CompactSequence):
+        return seq
+    kwargs = {'qual': seq.qual, 'original': seq.original,
+              'start': seq.start, 'end': seq.end, 'step': seq.step,
+              'defline': seq.defline}
+    if seq.original is seq:
+        del kwargs['original']
+    if 'type' in seq.__dict__:
+        kwargs['type'] = seq.type
+    return CompactSequence(seq.name, seq.seq, **kwargs)
+
+
+def sizeof(seq):
+    '''
+    Estimates the memory used, in bytes, by a sequence object along with its
+    dictionary (if it has one), name, definition line, sequence and quality
+    scores. This can be used to compare the footprint of a `Sequence` to
+    that of a `CompactSequence`.
+    '''
+
+    size = getsizeof(seq)
+    # looking up `__dict__` would make one for a `CompactSequence`.
+    for ref in get_referents(seq):
+        if type(ref) is dict:
+            size += getsizeof(ref)
+    for data in (seq.name, seq.defline, seq.seq, seq.qual):
+        if data is not None:
+            size += getsizeof(data)
+    return size
+
+
 def annotation(seq, source, type, **kwargs):
     '''
     Creates an `Annotation` object for the given sequence from a source
@@ -1,57 +1,252 @@
-_gencode = {
-    'ATA': 'I', 'ATC': 'I', 'ATT': 'I', 'ATG': 'M',
-    'AUA': 'I', 'AUC': 'I', 'AUU': 'I', 'AUG': 'M',
-    'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACT': 'T',
-    'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACU': 'T',
-    'AAC': 'N', 'AAT': 'N', 'AAA': 'K', 'AAG': 'K',
-    'AAC': 'N', 'AAU': 'N', 'AAA': 'K', 'AAG': 'K',
-    'AGC': 'S', 'AGT': 'S', 'AGA': 'R', 'AGG': 'R',
-    'AGC': 'S', 'AGU': 'S', 'AGA': 'R', 'AGG': 'R',
-    'CTA': 'L', 'CTC': 'L', 'CTG': 'L', 'CTT': 'L',
-    'CUA': 'L', 'CUC': 'L', 'CUG': 'L', 'CUU': 'L',
-    'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCT': 'P',
-    'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCU': 'P',
-    'CAC': 'H', 'CAT': 'H', 'CAA': 'Q', 'CAG': 'Q',
-    'CAC': 'H', 'CAU': 'H', 'CAA': 'Q', 'CAG': 'Q',
-    'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGT': 'R',
-    'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGU': 'R',
-    'GTA': 'V', 'GTC': 'V', 'GTG': 'V', 'GTT': 'V',
-    'GUA': 'V', 'GUC': 'V', 'GUG': 'V', 'GUU': 'V',
-    'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCT': 'A',
-    'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCU': 'A',
-    'GAC': 'D', 'GAT': 'D', 'GAA': 'E', 'GAG': 'E',
-    'GAC': 'D', 'GAU': 'D', 'GAA': 'E', 'GAG': 'E',
-    'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGT': 'G',
-    'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGU': 'G',
-    'TCA': 'S', 'TCC': 'S', 'TCG': 'S', 'TCT': 'S',
-    'UCA': 'S', 'UCC': 'S', 'UCG': 'S', 'UCU': 'S',
-    'TTC': 'F', 'TTT': 'F', 'TTA': 'L', 'TTG': 'L',
-    'UUC': 'F', 'UUU': 'F', 'UUA': 'L', 'UUG': 'L',
-    'TAC': 'Y', 'TAT': 'Y', 'TAA': '*', 'TAG': '*',
-    'UAC': 'Y', 'UAU': 'Y', 'UAA': '*', 'UAG': '*',
-    'TGC': 'C', 'TGT': 'C', 'TGA': '*', 'TGG': 'W',
-    'UGC': 'C', 'UGU': 'C', 'UGA': '*', 'UGG': 'W'}
-
-
-def translate(sequence):
-    '''
-    Translate a nucleotide using the standard genetic code. The sequence
+'''
+Translation of nucleotide sequences into protein sequences. Sequences are
+encoded once into small integer codes (0 through 3 for A, C, G, and T or U,
+and 4 for anything else) and each reading frame is then translated with a
+single lookup into a precompiled table of all 125 possible codons. Any of the
+NCBI genetic codes listed in `tables` can be used.
+'''
+
+from biotools.packed import PackedSequence
+from biotools.sequence import Sequence
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+
+# NCBI genetic codes: amino acids and start codons, codons in TCAG order.
+_ncbi = {
+    1: ('FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+        '---M---------------M---------------M----------------------------'),
+    2: ('FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSS**VVVVAAAADDEEGGGG',
+        '--------------------------------MMMM---------------M------------'),
+    3: ('FFLLSSSSYY**CCWWTTTTPPPPHHQQRRRRIIMMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+        '----------------------------------MM---------------M------------'),
+    4: ('FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+        '--MM---------------M------------MMMM---------------M------------'),
+    5: ('FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSSSVVVVAAAADDEEGGGG',
+        '---M----------------------------MMMM---------------M------------'),
+    6: ('FFLLSSSSYYQQCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+        '-----------------------------------M----------------------------'),
+    9: ('FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNNKSSSSVVVVAAAADDEEGGGG',
+        '-----------------------------------M---------------M------------'),
+    10: ('FFLLSSSSYY**CCCWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+         '-----------------------------------M----------------------------'),
+    11: ('FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+         '---M---------------M------------MMMM---------------M------------'),
+    12: ('FFLLSSSSYY**CC*WLLLSPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',
+         '-------------------M---------------M----------------------------'),
+    13: ('FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSGGVVVVAAAADDEEGGGG',
+         '---M------------------------------MM---------------M------------'),
+    14: ('FFLLSSSSYYY*CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNNKSSSSVVVVAAAADDEEGGGG',
+         '-----------------------------------M----------------------------')
+}
+
+_encode = np.empty(256, dtype=np.uint8)
+_encode.fill(4)
+for _i, _c in enumerate('ACGT'):
+    _encode[ord(_c)] = _encode[ord(_c.lower())] = _i
+_encode[ord('U')] = _encode[ord('u')] = 3
+_complement = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+_order = [a + b + c for a in 'TCAG' for b in 'TCAG' for c in 'TCAG']
+
+
+def _compile(aas):
+    '''
+    Turns an NCBI amino acid string into a lookup table indexed by
+    `25 * first + 5 * second + third` (using the codes from `_encode`);
+    codons with anything other than A, C, G, or T map to X.
+    '''
+
+    table = np.empty(125, dtype=np.uint8)
+    table.fill(ord('X'))
+    for codon, aa in zip(_order, aas):
+        a, b, c = ('ACGT'.index(x) for x in codon)
+        table[25 * a + 5 * b + c] = ord(aa)
+    return table
+
+tables = dict((n, _compile(_ncbi[n][0])) for n in _ncbi)
+
+
+def start_codons(table=1):
+    '''
+    The codons that can be used to initiate translation in the given NCBI
+    genetic code, e.g., ATG, GTG, TTG, and others for table 11.
+    '''
+
+    return [c for c, s in zip(_order, _ncbi[table][1]) if s == 'M']
+
+
+def stop_codons(table=1):
+    '''
+    The codons that terminate translation in the given NCBI genetic code.
+    '''
+
+    return [c for c, aa in zip(_order, _ncbi[table][0]) if aa == '*']
+
+
+def encode(sequence):
+    '''
+    Encodes a nucleotide string or `Sequence` as an array of small integers:
+    0 through 3 for A, C, G, and T (or U), and 4 for anything else.
+    '''
+
+    if isinstance(sequence, PackedSequence):
+        codes = sequence.codes().copy()
+        for start, end, c in sequence.exceptions:
+            codes[start:end] = 4
+        return codes
+    try:
+        sequence = sequence.seq
+    except AttributeError:
+        pass
+    if not isinstance(sequence, bytes):
+        sequence = sequence.encode('ascii', 'replace')
+    return _encode[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def _frame(codes, frame, table):
+    '''
+    Translates the encoded sequence starting at offset `frame`.
+    '''
+
+    n = (len(codes) - frame) // 3
+    codons = codes[frame:frame + 3 * n].reshape(-1, 3).astype(np.intp)
+    return tables[table][25 * codons[:, 0] + 5 * codons[:, 1] +
+                         codons[:, 2]].tostring()
+
+
+def translate(sequence, table=1):
+    '''
+    Translate a nucleotide using the standard genetic code, or any of the
+    NCBI genetic codes (e.g., `table=11` for bacteria). The sequence
     parameter can be either a string or a `Sequence` object. Stop codons are
     denoted with an asterisk (*).
     '''
 
+    return _wrap(sequence, _frame(encode(sequence), 0, table))
+
+
+def _wrap(sequence, value):
+    '''
+    Wraps a translated string up in the same way as the nucleotide sequence
+    it came from.
+    '''
+
+    if isinstance(sequence, PackedSequence):
+        return Sequence("translate(%s)" % sequence.name, value,
+                        original=sequence.original, type='prot',
+                        defline=sequence.defline)
     try:
-        value = ''.join(_gencode.get(sequence.seq[i:i + 3].upper(), 'X')
-                        for i in xrange(0, int(len(sequence) / 3) * 3, 3))
         return sequence.__class__("translate(%s)" % sequence.name, value,
                                   original=sequence.original, type='prot',
                                   defline=sequence.defline)
     except AttributeError:
-        value = ''.join(_gencode.get(sequence[i:i + 3].upper(), 'X')
-                        for i in xrange(0, int(len(sequence) / 3) * 3, 3))
         return sequence.__class__(value)
 
 
+def six_frames(sequence, table=1):
+    '''
+    Translates all six reading frames of a nucleotide sequence: the three
+    frames of the sequence itself followed by the three frames of its
+    reverse complement. The sequence is only encoded once. For strings, a
+    list of six strings is returned; for `Sequence`s, a list of six
+    translations, the same as `translate(seq[f:])` and
+    `translate(revcomp(seq)[f:])` for `f` in 0, 1, 2, would give.
+    '''
+
+    values = _frames(encode(sequence), table)
+    if not isinstance(sequence, Sequence):
+        return values
+
+    n = len(sequence)
+    rev = "complement(subsequence(%s, %d, %d, %d))" % \
+        ((sequence.name,) + slice(None, None, -1).indices(n))
+    names = ["subsequence(%s, %d, %d, %d)" %
+             ((name,) + slice(f, None).indices(n))
+             for name in (sequence.name, rev) for f in range(3)]
+    return [Sequence("translate(%s)" % name, value, type='prot',
+                     original=sequence.original, defline='')
+            for name, value in zip(names, values)]
+
+
+def _frames(codes, table):
+    '''
+    Translates all six frames of an encoded sequence.
+    '''
+
+    rcodes = _complement[codes[::-1]]
+    return [_frame(c, f, table) for c in (codes, rcodes) for f in range(3)]
+
+
+class TranslationCache(object):
+    '''
+    Keeps the six translated frames of up to `size` sequences (e.g., contigs
+    or database sequences) so that their subsequences can be translated by
+    slicing a frame instead of translating them again. The least recently
+    used sequence is forgotten first. The number of cache `hits` and
+    `misses` are kept so the cache can be sized sensibly.
+    '''
+
+    def __init__(self, size=256, table=1):
+        self.size = size
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def frames(self, sequence):
+        '''
+        The six translated frames of `sequence`, as strings, in the same
+        order as `six_frames`.
+        '''
+
+        key = id(sequence)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] is sequence:
+                self.hits += 1
+                self.entries[key] = entry
+                return entry[1]
+            self.misses += 1
+
+        entry = (sequence, _frames(encode(sequence), self.table))
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry[1]
+
+    def translate(self, sequence):
+        '''
+        Gives the same result as `translate(sequence)`. Whole sequences are
+        only translated once; forward or reverse subsequences of a sequence
+        (like open reading frames) are cut out of a frame of their original
+        sequence. Subsequences with a step of -1 are taken to be on the
+        reverse strand, i.e., slices of the reverse complement of their
+        original, as the open reading frames found by `ORFGenerator` are.
+        '''
+
+        original = sequence.original
+        if original is sequence:
+            return _wrap(sequence, self.frames(sequence)[0])
+        if abs(sequence.step) != 1 or original.step != 1:
+            return translate(sequence, self.table)
+
+        if sequence.step == 1:
+            offset, strand = sequence.start - original.start, 0
+        else:
+            offset, strand = original.end - sequence.start, 3
+        if offset < 0 or offset + len(sequence) > len(original):
+            return translate(sequence, self.table)
+
+        frame = self.frames(original)[strand + offset % 3]
+        first = offset // 3
+        return _wrap(sequence, frame[first:first + len(sequence) // 3])
+
+    def __len__(self):
+        return len(self.entries)
+
+
 if __name__ == '__main__':
     import sys
     print(translate(sys.argv[1]))